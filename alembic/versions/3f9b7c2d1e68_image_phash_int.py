@@ -0,0 +1,30 @@
+"""image_phash_int
+
+Revision ID: 3f9b7c2d1e68
+Revises: a6c41e9b7f05
+Create Date: 2025-06-12 11:08:41.512307
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9b7c2d1e68'
+down_revision: Union[str, None] = 'a6c41e9b7f05'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('image', sa.Column('phash_int', sa.BigInteger(), nullable=True))
+    # phashes are 16 hex digits, reinterpreted as a signed bigint
+    op.execute("UPDATE image SET phash_int = ('x' || lpad(phash, 16, '0'))::bit(64)::bigint")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('image', 'phash_int')
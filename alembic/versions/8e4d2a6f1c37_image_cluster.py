@@ -0,0 +1,34 @@
+"""image_cluster
+
+Revision ID: 8e4d2a6f1c37
+Revises: 3f9b7c2d1e68
+Create Date: 2025-06-13 15:42:19.874512
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8e4d2a6f1c37'
+down_revision: Union[str, None] = '3f9b7c2d1e68'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('image', sa.Column('cluster_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(None, 'image', 'image', ['cluster_id'], ['id'])
+    op.create_index(op.f('ix_image_cluster_id'), 'image', ['cluster_id'], unique=False)
+    op.create_index('ix_image_embedding_hnsw', 'image', ['embedding'], unique=False, postgresql_using='hnsw', postgresql_ops={'embedding': 'vector_cosine_ops'})
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_image_embedding_hnsw', table_name='image', postgresql_using='hnsw', postgresql_ops={'embedding': 'vector_cosine_ops'})
+    op.drop_index(op.f('ix_image_cluster_id'), table_name='image')
+    op.drop_constraint('image_cluster_id_fkey', 'image', type_='foreignkey')
+    op.drop_column('image', 'cluster_id')
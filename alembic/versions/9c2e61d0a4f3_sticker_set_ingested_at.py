@@ -0,0 +1,34 @@
+"""sticker_set.ingested_at
+
+Revision ID: 9c2e61d0a4f3
+Revises: 4541416a7914
+Create Date: 2025-06-02 14:12:41.503118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c2e61d0a4f3'
+down_revision: Union[str, None] = '4541416a7914'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('sticker_set', sa.Column('ingested_at', sa.DateTime(timezone=True), nullable=True))
+    op.drop_constraint('sticker_image_id_key', 'sticker', type_='unique')
+    op.drop_constraint('sticker_sticker_pack_id_key', 'sticker', type_='unique')
+    op.create_unique_constraint(None, 'sticker', ['image_id', 'sticker_pack_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('sticker_image_id_sticker_pack_id_key', 'sticker', type_='unique')
+    op.create_unique_constraint('sticker_sticker_pack_id_key', 'sticker', ['sticker_pack_id'])
+    op.create_unique_constraint('sticker_image_id_key', 'sticker', ['image_id'])
+    op.drop_column('sticker_set', 'ingested_at')
@@ -0,0 +1,28 @@
+"""image_tg_ref_updated_at
+
+Revision ID: d2b8e5a14f90
+Revises: 8e4d2a6f1c37
+Create Date: 2025-06-16 10:21:05.631948
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd2b8e5a14f90'
+down_revision: Union[str, None] = '8e4d2a6f1c37'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('image', sa.Column('tg_ref_updated_at', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('image', 'tg_ref_updated_at')
@@ -0,0 +1,32 @@
+"""channel crawl checkpoint
+
+Revision ID: e07f5b3c8d21
+Revises: 9c2e61d0a4f3
+Create Date: 2025-06-03 11:47:09.215384
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e07f5b3c8d21'
+down_revision: Union[str, None] = '9c2e61d0a4f3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('channel', sa.Column('crawl_min_id', sa.Integer(), nullable=True))
+    op.add_column('channel', sa.Column('crawl_max_id', sa.Integer(), nullable=True))
+    op.add_column('channel', sa.Column('crawl_complete', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('channel', 'crawl_complete')
+    op.drop_column('channel', 'crawl_max_id')
+    op.drop_column('channel', 'crawl_min_id')
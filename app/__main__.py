@@ -1,12 +1,29 @@
 import asyncio
-from app.bot import bot
+from app.bot import bot, background_tasks
 from app.config import config
-from app.userbot_client import client
+from app.phash_index import phash_index
+from app.tg_refs import prewarm_loop, sweep_loop
+from app.config import USERBOT_SESSION_FILE
+from app.userbot_client import get_client, load_tracked_channels, lock_session, start_pool
+from app.worker import IngestWorker
 
 
 async def main():
     await bot.start(config.bot_token)
+    lock_session(USERBOT_SESSION_FILE)
+    client = get_client()
     await client.start()
+    pool = await start_pool(client)
+    await load_tracked_channels()
+    await phash_index.refresh()
+    loops = []
+    if config.embedded_worker:
+        loops.append(IngestWorker(pool).run())
+    if config.prewarm_rate:
+        loops += [prewarm_loop(bot), sweep_loop(bot)]
+    for loop in loops:
+        # referenced there so they aren't garbage collected while running
+        background_tasks.add(asyncio.create_task(loop))
     await bot.run_until_disconnected()
 
 
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+class Account:
+    def __init__(self, name: str, client: TelegramClient):
+        self.name = name
+        self.client = client
+        # time.monotonic() until which telegram asked us to wait
+        self.cooldown_until = 0.0
+        self.active = 0
+        self.flood_waits = 0
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.cooldown_until
+
+    def status(self) -> str:
+        if not self.available:
+            return f"{self.name}: cooling down for {self.cooldown_until - time.monotonic():.0f}s"
+        return f"{self.name}: {self.active} active, {self.flood_waits} flood waits"
+
+
+class AccountPool:
+    """
+    Spreads telegram requests across several userbot accounts.
+
+    Telethon still sleeps through short flood waits itself (flood_sleep_threshold),
+    longer ones put the account on cooldown and the request is retried on
+    the least busy account that isn't cooling down.
+    """
+
+    def __init__(self):
+        self.accounts: list[Account] = []
+
+    def add(self, name: str, client: TelegramClient):
+        self.accounts.append(Account(name, client))
+
+    def _cool_down(self, account: Account, exc: FloodWaitError):
+        account.cooldown_until = time.monotonic() + exc.seconds
+        account.flood_waits += 1
+        logger.warning('Account %s got a flood wait of %ss', account.name, exc.seconds)
+
+    def account_of(self, client: TelegramClient) -> Account | None:
+        return next((account for account in self.accounts if account.client is client), None)
+
+    async def account_for(self, peer) -> Account | None:
+        """
+        None if every account can use peer (a username), otherwise the first account
+        that has it cached. Access hashes differ between accounts, so requests for
+        such a peer must be pinned to that account.
+        """
+        if isinstance(peer, str):
+            return None
+        for account in self.accounts:
+            try:
+                await account.client.get_input_entity(peer)
+                return account
+            except ValueError:
+                continue
+        raise ValueError(f'No userbot account can resolve {peer}')
+
+    async def acquire(self, pinned: Account | None = None) -> Account:
+        """
+        Least busy available account, waits for the first cooldown to end if there is none.
+        With pinned, waits for that account's cooldown to end instead.
+        """
+        if pinned is not None:
+            await asyncio.sleep(max(pinned.cooldown_until - time.monotonic(), 0))
+            return pinned
+        if not self.accounts:
+            raise RuntimeError('No userbot accounts')
+        while True:
+            available = [account for account in self.accounts if account.available]
+            if available:
+                return min(available, key=lambda account: account.active)
+            wait = min(account.cooldown_until for account in self.accounts) - time.monotonic()
+            await asyncio.sleep(max(wait, 0))
+
+    async def call(self, func: Callable[[TelegramClient], Awaitable[T]], pinned: Account | None = None) -> T:
+        """
+        Run func with some account's client, or only with pinned. func may run more than once,
+        so it should resolve everything account-specific (entities, access hashes) itself.
+        """
+        while True:
+            account = await self.acquire(pinned)
+            account.active += 1
+            try:
+                return await func(account.client)
+            except FloodWaitError as exc:
+                self._cool_down(account, exc)
+            finally:
+                account.active -= 1
+
+    async def iter_messages(self, peer, pinned: Account | None = None, **kwargs) -> AsyncIterator:
+        """
+        Like TelegramClient.iter_messages from the newest message down, but on a flood
+        wait continues below the last yielded message with another account.
+        peer must be resolvable by every account, e.g. a username, or pinned to account_for(peer).
+        """
+        offset_id = kwargs.pop('offset_id', 0)
+        while True:
+            account = await self.acquire(pinned)
+            account.active += 1
+            try:
+                entity = await account.client.get_input_entity(peer)
+                async for message in account.client.iter_messages(entity, offset_id=offset_id, **kwargs):
+                    offset_id = message.id
+                    yield message
+                return
+            except FloodWaitError as exc:
+                self._cool_down(account, exc)
+            finally:
+                account.active -= 1
+
+    def status(self) -> str:
+        return '\n'.join(account.status() for account in self.accounts)
+
+
+__all__ = ['Account', 'AccountPool']
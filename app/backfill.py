@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+import sqlalchemy as sa
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.config import config
+from app.db import engine, new_session
+from app.ingest import EMB_EXECUTOR, OCR_EXECUTOR
+from app.models import BackfillCheckpoint, Image
+from app.storage import store
+from app.utils import embed_images, noop, process_image
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64
+
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+
+@dataclass
+class BackfillTask:
+    # also the checkpoint key
+    name: str
+    column: str
+    # selects the images to process
+    where: Any
+    # maps a list of images to column values, runs in the executor
+    compute: Callable[[list[bytes]], list[Any]]
+    executor: ThreadPoolExecutor
+
+
+def _ocr_images(images: list[bytes]) -> list[str]:
+    return [process_image(image) for image in images]
+
+
+EMBEDDING_TASK = BackfillTask('embedding', 'embedding', Image.embedding == None, embed_images, EMB_EXECUTOR)
+# re-runs OCR on every image, e.g. after switching the OCR engine
+OCR_TASK = BackfillTask('ocr', 'text', sa.true(), _ocr_images, OCR_EXECUTOR)
+
+
+def _compute_chunk(task: BackfillTask, rows) -> list[tuple[int, Any]]:
+    images = [(row.id, store.read(row.phash)) for row in rows]
+    images = [(id_, data) for id_, data in images if data is not None]
+    try:
+        values = task.compute([data for _, data in images])
+        return [(id_, value) for (id_, _), value in zip(images, values)]
+    except Exception:
+        logger.exception('Backfill %s failed on a chunk, retrying one by one', task.name)
+    result = []
+    for id_, data in images:
+        try:
+            result.append((id_, task.compute([data])[0]))
+        except Exception:
+            logger.exception('Backfill %s failed on image %s', task.name, id_)
+    return result
+
+
+async def _write_chunk(task: BackfillTask, results: list[tuple[int, Any]], last_id: int):
+    """One UPDATE ... FROM (VALUES ...) for the whole chunk, committed together with the checkpoint"""
+    column_type = Image.__table__.c[task.column].type
+    async with new_session():
+        if results:
+            values = sa.values(
+                sa.column('id', sa.Integer), sa.column('value', column_type), name='v'
+            ).data(results)
+            await db.session.execute(
+                update(Image)
+                .where(Image.id == values.c.id)
+                .values({task.column: sa.cast(values.c.value, column_type)})
+                .execution_options(synchronize_session=False)
+            )
+        await db.session.execute(
+            insert(BackfillCheckpoint)
+            .values(name=task.name, last_id=last_id)
+            .on_conflict_do_update(
+                index_elements=[BackfillCheckpoint.name],
+                set_={'last_id': last_id, 'updated_at': func.now()},
+            )
+        )
+
+
+async def run_backfill(
+    task: BackfillTask,
+    chunk_size: int = CHUNK_SIZE,
+    max_rate: float | None = None,
+    restart: bool = False,
+    on_progress: ProgressCallback = noop,
+) -> tuple[int, int]:
+    """
+    Streams matching image ids with a server-side cursor and processes them
+    chunk by chunk off the event loop, resuming from the last checkpoint.
+    max_rate limits images per second so inline search keeps its share of the CPU.
+    Returns the number of updated and failed images.
+    """
+    if max_rate is None:
+        max_rate = config.backfill_max_rate
+    async with new_session():
+        if restart:
+            await db.session.execute(delete(BackfillCheckpoint).where(BackfillCheckpoint.name == task.name))
+        checkpoint = await BackfillCheckpoint.get(task.name)
+    last_id = checkpoint.last_id if checkpoint else 0
+
+    loop = asyncio.get_running_loop()
+    updated = failed = 0
+    async with engine.connect() as conn:
+        result = await conn.stream(
+            select(Image.id, Image.phash)
+            .where(task.where, Image.id > last_id)
+            .order_by(Image.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        async for rows in result.partitions():
+            started = time.monotonic()
+            results = await loop.run_in_executor(task.executor, _compute_chunk, task, rows)
+            await _write_chunk(task, results, rows[-1].id)
+            updated += len(results)
+            failed += len(rows) - len(results)
+            await on_progress(updated, failed)
+            if max_rate:
+                await asyncio.sleep(max(0.0, len(rows) / max_rate - (time.monotonic() - started)))
+
+    async with new_session():
+        await db.session.execute(delete(BackfillCheckpoint).where(BackfillCheckpoint.name == task.name))
+    return updated, failed
+
+
+__all__ = ['BackfillTask', 'EMBEDDING_TASK', 'OCR_TASK', 'run_backfill']
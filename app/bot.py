@@ -1,39 +1,38 @@
 import asyncio
-import struct
+import functools
+import html
+import json
 import time
 import traceback
-from concurrent.futures import ThreadPoolExecutor
-from typing import Any
+from typing import Any, Awaitable, Callable
 from uuid import uuid4
 
-import sqlalchemy as sa
-from imagehash import phash
-from sqlalchemy import func, select, update
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import func, select
 from telethon import Button, events
+from telethon.errors import RPCError
 from telethon.events import StopPropagation, InlineQuery
 from telethon.tl.functions.channels import JoinChannelRequest
-from telethon.tl.functions.messages import GetStickerSetRequest
-from telethon.tl.types import DocumentAttributeSticker, UpdateBotInlineSend, Photo, Document, InputPhoto, InputDocument
+from telethon.tl.types import DocumentAttributeFilename, PeerChannel, UpdateBotInlineSend
 
-from app import db
-from app.bot_client import BotClient, MiddlewareCallback, Command, Message, NewMessage
-from app.config import IMAGES_DIR, SESSION_FILE, config
+from app import db, metrics, search
+from app.bot_client import BotClient, MiddlewareCallback, Command, NewMessage
+from app.config import SESSION_FILE, config
 from app.db import new_session
+from app.backfill import EMBEDDING_TASK, OCR_TASK, run_backfill
+from app.clusters import cluster_unassigned
+from app.crawl import ChannelCrawl
+from app.jobs import job_counts
 from app.models import Image, ChannelMessage
 from app.models.image_usage import ImageUsage
 from app.models.sticker import StickerSet, Sticker
-from app.userbot_client import client
+from app.phash_index import phash_index
+from app.tg_refs import clear_refs, stale_ref_images, unpack_file_ref, uploads
+from app.userbot_client import get_client, pool, track_channel
 from app.utils import (
     get_or_create_channel,
-    StickerData,
-    MessageData,
-    is_ad_message,
-    process_media_message,
-    download_to_path,
-    embed_text, embed_image,
+    calculate_phash,
+    phash_to_int,
 )
-from PIL import Image as PILImage
 
 async def create_db_session_middleware(
     _event: Any, callback: MiddlewareCallback
@@ -51,6 +50,9 @@ async def create_db_session_middleware(
 bot = BotClient(str(SESSION_FILE), config.api_id, config.api_hash)
 bot.add_middleware(create_db_session_middleware)
 
+# fire-and-forget tasks, referenced here so they aren't garbage collected while running
+background_tasks: set[asyncio.Task] = set()
+
 
 @bot.on(events.Raw([UpdateBotInlineSend]))
 async def feedback(event: UpdateBotInlineSend):
@@ -86,94 +88,62 @@ async def on_start(e: Command.Event):
     )
 
 
-def image_to_tg(image: Image):
-    if image.tg_ref:
-        return unpack_file_ref(image.tg_ref)
-    file_path = IMAGES_DIR / f'{image.phash}.jpg'
-    if not file_path.exists():
-        return None
-    if config.debug:
-        return file_path
-    else:
-        return config.external_url + f'/{image.phash}.jpg'
-
-
-def pack_file_ref(file: InputPhoto | Photo | InputDocument | Document) -> bytes:
-    type_ = 1 if isinstance(file, (Photo, InputPhoto)) else 2
-    return struct.pack('>Hqq', type_, file.id, file.access_hash) + file.file_reference
-
-
-def unpack_file_ref(file_ref: bytes) -> InputPhoto | InputDocument:
-    type_, id_, access_hash = struct.unpack('>Hqq', file_ref[:2 + 8 + 8])
-    file_ref = file_ref[2 + 8 + 8:]
-    if type_ == 1:
-        return InputPhoto(id_, access_hash, file_ref)
-    elif type_ == 2:
-        return InputDocument(id_, access_hash, file_ref)
-
-
 async def respond_with_images(e: InlineQuery.Event, images, offset, limit):
-    converted_images = [(image_to_tg(img), img) for img in images]
-    filtered_images = [x for x in converted_images if x[0]]
-    results = await asyncio.gather(
-        *[e.builder.photo(input_img, id=f'{img.id}_{uuid4()}') for input_img, img in filtered_images]
-    )
-    for i, img in enumerate(images):
-        if not img.tg_ref:
-            img.tg_ref = pack_file_ref(results[i].photo)
-    await e.answer(
-        results,
-        gallery=True,
-        next_offset=str(offset + limit),
-    )
-
+    new_refs = {}
+    try:
+        # a cached tg_ref may have expired, the answer is retried once with those refs cleared
+        for attempt in range(2):
+            refs = await uploads.get_refs(e.client, images)
+            new_refs = {img.id: refs[img.id] for img in images if not img.tg_ref and img.id in refs}
+            shown = [img for img in images if img.id in refs]
+            results = await asyncio.gather(
+                *[e.builder.photo(unpack_file_ref(refs[img.id]), id=f'{img.id}_{uuid4()}') for img in shown]
+            )
+            try:
+                await e.answer(
+                    results,
+                    gallery=True,
+                    next_offset=str(offset + limit),
+                )
+                break
+            except RPCError as exc:
+                stale = stale_ref_images(exc, shown)
+                if attempt or not stale:
+                    raise
+                await clear_refs([img.id for img in stale])
+    except BaseException:
+        # nobody saves them, the next query uploads again
+        uploads.forget(new_refs)
+        raise
 
-async def respond_with_most_used(e: InlineQuery.Event, offset, limit, query):
-    usage_count_q = (
-        select(
-            ImageUsage.image_id.label('image_id'),
-            func.count(ImageUsage.id).label('usage_count'),
-        )
-        .group_by(ImageUsage.image_id)
-        .subquery()
-    )
+    if new_refs:
+        # the user already has the answer, don't make the handler wait for the write
+        task = asyncio.create_task(uploads.save(new_refs))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
 
-    images = await db.fetch_vals(
-        select(Image)
-        .join(usage_count_q, usage_count_q.c.image_id == Image.id)
-        # .where(usage_count_q.c.usage_count > 0)
-        .order_by(usage_count_q.c.usage_count.desc())
-        .limit(limit)
-        .offset(offset)
-    )
 
-    return await respond_with_images(e, images, offset, limit)
+SIMILAR_PREFIX = 'similar:'
 
 
 @bot.on(InlineQuery())
 async def on_inline(e: InlineQuery.Event):
     offset = int(e.offset or '0')
-    limit = 10
+    limit = search.PAGE_SIZE
     query = (e.text or '').strip()
     if not query:
-        return await respond_with_most_used(e, offset, limit, query)
-
-    qvec = embed_text(query)
+        return await respond_with_images(e, await search.most_used(offset, limit), offset, limit)
 
-    emb_dist = func.greatest(
-        sa.cast(Image.embedding.op('<=>')(qvec), sa.Float) - 0.8, 0.0
-    ).label('emb_dist')
-    txt_dist = Image.text.op('<->>')(query).label('txt_dist')
+    if query.startswith(SIMILAR_PREFIX):
+        qvec = await search.recall_embedding(query.removeprefix(SIMILAR_PREFIX))
+        if qvec is None:
+            return await e.answer(switch_pm='Search expired, send the image again', switch_pm_param='expired')
+        images = await search.similar(qvec, offset, limit)
+        if not images:
+            return await e.answer(None)
+        return await respond_with_images(e, images, offset, limit)
 
-    dist = sa.case(
-        (Image.embedding == None, txt_dist),
-        (Image.text == None, emb_dist),
-        else_=func.least(emb_dist, txt_dist),
-    ).label('dist')
-
-    images = await db.fetch_vals(
-        select(Image).where(dist < 0.7).order_by(dist).limit(limit).offset(offset)
-    )
+    images = await search.search(query, offset, limit)
 
     if not images:
         if offset == 0:
@@ -186,6 +156,9 @@ async def on_inline(e: InlineQuery.Event):
     await respond_with_images(e, images, offset, limit)
 
 
+MAX_SOURCES = 20
+
+
 @bot.on(NewMessage(pm_only=True))
 async def on_pm(e: NewMessage.Event):
     if e.message.photo is None:
@@ -193,59 +166,100 @@ async def on_pm(e: NewMessage.Event):
         return
 
     msg = await e.message.respond('Searching sources...')
-    photo_save_path = f'/tmp/{e.message.photo.id}.jpg'
-    await e.message.download_media(file=photo_save_path, thumb=-1)
-    image_phash = str(phash(PILImage.open(photo_save_path)))
+    data = await e.message.download_media(bytes, thumb=-1)
+    image_phash = await asyncio.to_thread(calculate_phash, data)
+    # the embedding is computed once the button is used
+    buttons = [Button.switch_inline('Similar memes', query=SIMILAR_PREFIX + search.remember_image(data))]
+
+    await phash_index.refresh()
+    matches = phash_index.query(phash_to_int(image_phash), config.reverse_search_distance)
+    distances = dict(matches)
 
     results = []
 
     messages = await db.fetch_vals(
-        select(ChannelMessage).join(Image).where(Image.phash == image_phash)
+        select(ChannelMessage).where(ChannelMessage.image_id.in_(distances))
     )
-    if messages:
-        results.extend([
-            f't.me/c/{message.channel_id}/{message.message_id}'
-            for message in messages
-        ])
-    sticker_sets = await db.fetch_vals(
-        select(StickerSet).join(Sticker).join(Image)
+    messages = sorted(messages, key=lambda message: distances[message.image_id])
+    results.extend([
+        f't.me/c/{message.channel_id}/{message.message_id}'
+        for message in messages[:MAX_SOURCES]
+    ])
+    sticker_sets = await db.fetch_all(
+        select(StickerSet, func.min(Sticker.image_id))
+        .join(Sticker)
+        .where(Sticker.image_id.in_(distances))
+        .group_by(StickerSet.id)
     )
-    if sticker_sets:
-        results.extend([f"t.me/addstickers/{pack.short_name}" for pack in sticker_sets])
-    await msg.edit('Found sources:\n' + '\n'.join(results) if results else 'No sources found')
+    sticker_sets = sorted(sticker_sets, key=lambda row: distances[row[1]])
+    results.extend([f"t.me/addstickers/{pack.short_name}" for pack, _ in sticker_sets[:MAX_SOURCES]])
+    await msg.edit('Found sources:\n' + '\n'.join(results) if results else 'No sources found', buttons=buttons)
 
 
-OCR_EXECUTOR = ThreadPoolExecutor(max_workers=1)
-EMB_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+async def _run_backfill(e, run: Callable[..., Awaitable[tuple[int, int]]]):
+    mess = await e.message.reply("Processed 0")
+    last_edited = time.time()
+
+    async def on_progress(updated, failed):
+        nonlocal last_edited
+        if time.time() - last_edited > 10:
+            last_edited = time.time()
+            await mess.edit(f"Processed {updated}, failed {failed}")
+
+    try:
+        updated, failed = await run(on_progress=on_progress)
+    except Exception as exc:
+        traceback.print_exc()
+        await mess.edit(f"Stopped: {exc}\nRun the command again to resume")
+        return
+    await mess.edit(f"Updated {updated}, failed {failed}")
+
 
 @bot.on(Command("update_embedding"))
 async def on_update_embedding(e):
     #looks into database, if vector embedding is None or empty, update it
     if e.message.chat_id != config.admin_group_id:
         return
+    restart = e.args.strip() == 'restart'
+    await _run_backfill(e, functools.partial(run_backfill, EMBEDDING_TASK, restart=restart))
 
-    mess = await e.message.reply("Processed 0")
-    last_edited = time.time()
-    updated = 0
-    images = await db.fetch_vals(
-        select(Image).where(Image.embedding == None)
-    )
-    if not images:
-        await e.message.reply("No images to update")
+
+@bot.on(Command("reocr"))
+async def on_reocr(e):
+    #re-runs OCR on all images, resumes an interrupted run unless called with "restart"
+    if e.message.chat_id != config.admin_group_id:
         return
-    for img in images:
-        try:
-            vec = embed_image(str(IMAGES_DIR / f"{img.phash}.jpg"))
-            async with new_session():
-                await db.session.execute(update(Image).where(Image.id == img.id).values(embedding=vec))
-            updated += 1
-            if time.time() - last_edited > 10:
-                last_edited = time.time()
-                await mess.edit(f"Processed {updated} out of {len(images)}")
-        except Exception as exc:
-            await e.message.reply(f"Error processing {img}: {exc}")
-            traceback.print_exc()
-    await mess.edit(f"Updated {updated} out of {len(images)}")
+    restart = e.args.strip() == 'restart'
+    await _run_backfill(e, functools.partial(run_backfill, OCR_TASK, restart=restart))
+
+
+@bot.on(Command("cluster"))
+async def on_cluster(e):
+    #groups images stored before clustering existed into near-duplicate clusters
+    if e.message.chat_id != config.admin_group_id:
+        return
+    await _run_backfill(e, cluster_unassigned)
+
+
+async def format_job_counts() -> str:
+    async with new_session():
+        counts = await job_counts()
+    return '\n'.join(f"{status}: {count}" for status, count in sorted(counts.items())) or "No jobs"
+
+
+@bot.on(Command("ingest_stats"))
+async def on_ingest_stats(e):
+    if e.message.chat_id != config.admin_group_id:
+        return
+    snapshots = await asyncio.to_thread(metrics.read_snapshots)
+    if e.args.strip() == 'json':
+        text = json.dumps(snapshots, indent=1)
+        await e.message.reply(file=text.encode(), attributes=[DocumentAttributeFilename('ingest_stats.json')])
+        return
+    await e.message.reply(
+        f"<pre>{html.escape(metrics.format_snapshots(snapshots))}</pre>\n\n{await format_job_counts()}\n\n"
+        f"<pre>{html.escape(pool.status())}</pre>"
+    )
 
 
 @bot.on(Command("download_channel"))
@@ -264,71 +278,29 @@ async def on_download_channel(e):
         run_vector = False
         channel_name = channel_name.replace("!text", "").strip()
 
-    channel_tg = await client.get_entity(channel_name)
+    channel_tg = await get_client().get_entity(channel_name)
     async with new_session():
         channel = await get_or_create_channel(channel_tg.id, channel_tg.title, channel_tg.username)
+    track_channel(channel.id)
 
-    work_q: asyncio.Queue[StickerData | MessageData | None] = asyncio.Queue()
-    processed = queued = 0
-    last_edited = time.time()
-    mess = await e.message.reply("Downloading 0 / Processed 0")
+    mess = await e.message.reply("Queued 0 jobs")
 
-    async def worker():
-        nonlocal processed, last_edited
+    async def report_progress():
         while True:
-            item = await work_q.get()
-            if item is None:
-                work_q.task_done()
-                break
-            try:
-                # передаём оба executors
-                await process_media_message(item, OCR_EXECUTOR, EMB_EXECUTOR, run_ocr, run_vector)
-                processed += 1
-                if time.time() - last_edited > 10:
-                    last_edited = time.time()
-                    await mess.edit(f"Downloading {queued} / Processed {processed}")
-            except Exception as exc:
-                traceback.print_exc()
-                await mess.reply(f"Error processing {item}: {exc}")
-            finally:
-                work_q.task_done()
-
-    worker_task = asyncio.create_task(worker())
-
-    it = client.iter_messages(channel_tg)
-    async for message in it:
-        message: Message
-        if is_ad_message(message):
-            continue
-        if message.photo:
-            path, ph = await download_to_path(message)
-            await work_q.put(MessageData(path, ph, channel.id, message.id))
-        elif message.sticker:
-            input_sticker_set = next(attr for attr in message.document.attributes if isinstance(attr, DocumentAttributeSticker)).stickerset
-            sticker_set = await client(GetStickerSetRequest(input_sticker_set, 0))
-            async with new_session():
-                await db.session.execute(insert(StickerSet).values(
-                    id=sticker_set.set.id,
-                    short_name=sticker_set.set.short_name,
-                ).on_conflict_do_nothing())
-            for document in sticker_set.documents:
-                path, ph = await download_to_path(document)
-                await work_q.put(StickerData(path, ph, sticker_set.set.id))
-        else:
-            continue
-        queued += 1
-        if time.time() - last_edited > 10:
-            last_edited = time.time()
-            await mess.edit(f"Downloading {queued} / Processed {processed}")
+            await asyncio.sleep(10)
+            await mess.edit(f"{crawl.status()}\n\n{await format_job_counts()}")
 
-    await work_q.join()
-    await work_q.put(None)
-    await worker_task
+    crawl = ChannelCrawl(channel.id, channel_tg.username or PeerChannel(channel_tg.id), run_ocr, run_vector)
+    progress_task = asyncio.create_task(report_progress())
+    try:
+        await crawl.run()
+    finally:
+        progress_task.cancel()
 
-    await mess.edit(f"Download finished: {queued} queued, {processed} processed")
+    await mess.edit(f"Download finished: {crawl.queued} jobs queued\n\n{await format_job_counts()}")
 
     try:
-        await client(JoinChannelRequest(channel_tg))
+        await get_client()(JoinChannelRequest(channel_tg))
     except Exception as exc:
         await e.message.reply(f"Error joining channel {channel_name}: {exc}")
 
@@ -0,0 +1,133 @@
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy import select, update
+
+from app import db
+from app.config import config
+from app.db import new_session
+from app.models import Image
+from app.phash_index import phash_index
+from app.utils import noop, phash_to_int
+
+
+def _cosine_distance(a, b) -> float:
+    return 1 - float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+async def _nearest_representatives(embeddings: dict[int, list[float]]) -> dict[int, tuple[int, float]]:
+    """
+    Closest stored cluster representative within cluster_embedding_distance of each
+    embedding, as image id -> (representative id, distance). One statement for all of them.
+    """
+    if not embeddings:
+        return {}
+    embedding_type = Image.__table__.c.embedding.type
+    values = sa.values(
+        sa.column('id', sa.Integer), sa.column('embedding', embedding_type), name='v'
+    ).data(list(embeddings.items()))
+    dist = Image.embedding.op('<=>')(sa.cast(values.c.embedding, embedding_type))
+    nearest = (
+        select(Image.id.label('match_id'), dist.label('distance'))
+        .where(Image.cluster_id == Image.id, dist < config.cluster_embedding_distance)
+        .order_by(dist)
+        .limit(1)
+        .lateral('nearest')
+    )
+    rows = await db.fetch_all(
+        select(values.c.id, nearest.c.match_id, nearest.c.distance).select_from(values.join(nearest, sa.true()))
+    )
+    return {row.id: (row.match_id, row.distance) for row in rows}
+
+
+async def assign_clusters(images: dict[int, tuple[str, list[float] | None]]):
+    """
+    Put images (id -> (phash, embedding)) without a cluster into the cluster of
+    their closest near-duplicate: by phash first, then by embedding. Images with
+    no near-duplicate start their own cluster and represent it.
+    Must be called inside a session, after the images are added to phash_index.
+    Takes a fixed number of statements however many images there are.
+    """
+    pending = await db.fetch_vals(
+        select(Image.id).where(Image.id.in_(images), Image.cluster_id == None).order_by(Image.id)
+    )
+    if not pending:
+        return
+
+    matches = {
+        image_id: [
+            match_id
+            for match_id, _ in phash_index.query(phash_to_int(images[image_id][0]), config.cluster_phash_distance)
+            if match_id != image_id
+        ]
+        for image_id in pending
+    }
+    candidate_ids = {match_id for ids in matches.values() for match_id in ids}
+    clusters: dict[int, int] = dict(await db.fetch_all(
+        select(Image.id, Image.cluster_id).where(Image.id.in_(candidate_ids), Image.cluster_id != None)
+    )) if candidate_ids else {}
+
+    # stored representatives for images that may not find a phash match, looked up together
+    stored = await _nearest_representatives({
+        image_id: images[image_id][1]
+        for image_id in pending
+        if images[image_id][1] is not None and not any(match_id in clusters for match_id in matches[image_id])
+    })
+    # representatives started by this batch, compared in memory
+    new_representatives: dict[int, np.ndarray] = {}
+
+    for image_id in pending:
+        # matches are sorted by distance, clusters also holds images assigned earlier in this batch
+        cluster_id = next((clusters[match_id] for match_id in matches[image_id] if match_id in clusters), None)
+        embedding = images[image_id][1]
+        if cluster_id is None and embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            candidates = [stored[image_id]] if image_id in stored else []
+            candidates += [
+                (representative_id, _cosine_distance(embedding, representative))
+                for representative_id, representative in new_representatives.items()
+            ]
+            candidates = [candidate for candidate in candidates if candidate[1] < config.cluster_embedding_distance]
+            if candidates:
+                cluster_id = min(candidates, key=lambda candidate: candidate[1])[0]
+            else:
+                new_representatives[image_id] = embedding
+        clusters[image_id] = cluster_id or image_id
+
+    values = sa.values(
+        sa.column('id', sa.Integer), sa.column('cluster_id', sa.Integer), name='v'
+    ).data([(image_id, clusters[image_id]) for image_id in pending])
+    await db.session.execute(
+        update(Image)
+        .where(Image.id == values.c.id)
+        .values(cluster_id=values.c.cluster_id)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def cluster_unassigned(chunk_size: int = 500, on_progress=noop) -> tuple[int, int]:
+    """Cluster images stored before clustering existed, oldest first"""
+    await phash_index.refresh()
+    done = 0
+    last_id = 0
+    while True:
+        async with new_session():
+            rows = await db.fetch_all(
+                select(Image.id, Image.phash, Image.embedding)
+                .where(Image.cluster_id == None, Image.id > last_id)
+                .order_by(Image.id)
+                .limit(chunk_size)
+            )
+            if not rows:
+                return done, 0
+            await assign_clusters({row.id: (row.phash, row.embedding) for row in rows})
+        last_id = rows[-1].id
+        done += len(rows)
+        await on_progress(done, 0)
+
+
+def is_representative():
+    """Images shown in search results, unclustered images represent themselves"""
+    return sa.or_(Image.cluster_id == None, Image.cluster_id == Image.id)
+
+
+__all__ = ['assign_clusters', 'cluster_unassigned', 'is_representative']
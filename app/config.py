@@ -1,9 +1,14 @@
 from pathlib import Path
+from typing import Literal
+
 from pydantic_settings import BaseSettings
 
 
 class Config(BaseSettings):
     db_url: str
+    # connections kept open per process, the web app and the bot each have their own pool
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
     data_dir: Path = 'data'
     debug: bool = False
     
@@ -16,13 +21,42 @@ class Config(BaseSettings):
     port: int = 8000
     external_url: str
 
+    # process ingestion jobs inside the bot, disable when running `python -m app.worker` separately
+    embedded_worker: bool = True
+    # 'original' downloads full size photos, 'thumbnail' downloads the smallest
+    # telegram thumbnail covering ingest_thumb_size and fetches the original only for OCR
+    ingest_mode: Literal['original', 'thumbnail'] = 'original'
+    ingest_thumb_size: int = 384
+    # images per second processed by /update_embedding and /reocr, 0 disables the limit
+    backfill_max_rate: float = 20
+    # max hamming distance between phashes of a reverse search match
+    reverse_search_distance: int = 6
+    # images closer than either threshold are near-duplicates and share a cluster
+    cluster_phash_distance: int = 4
+    cluster_embedding_distance: float = 0.05
+    # images per second uploaded in the background to get a tg_ref, 0 disables prewarming
+    prewarm_rate: float = 1
+    # tg_refs older than this are re-validated by the sweeper
+    tg_ref_max_age_hours: float = 24
+    # resized copies served by the web app, least recently used are evicted above this size
+    derivatives_max_mb: int = 1024
+    # derivatives generated at ingest instead of on first request, e.g. ["thumb.webp"]
+    pregenerate_derivatives: list[str] = []
+    # derivative telegram fetches for inline results, jpg is the format telegram reliably accepts for photos
+    inline_derivative: str = 'medium.jpg'
+    # 'files' stores one file per image, 'segments' packs them into large segment files
+    image_store: Literal['files', 'segments'] = 'files'
+
 
 config = Config(_env_file='.env')
 SESSION_FILE = config.data_dir / 'bot.session'
 IMAGES_DIR = config.data_dir / 'images'
 USERBOT_SESSION_FILE = config.data_dir / 'userbot.session'
+# extra userbot accounts used for crawling and downloads, one .session file each
+SESSIONS_DIR = config.data_dir / 'sessions'
 
 config.data_dir.mkdir(parents=True, exist_ok=True)
 IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
 
 __all__ = ['config', 'SESSION_FILE', 'IMAGES_DIR']
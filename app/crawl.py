@@ -0,0 +1,106 @@
+import time
+
+from sqlalchemy import update
+from telethon.tl.types import DocumentAttributeSticker
+
+from app import db
+from app.bot_client import Message
+from app.db import new_session
+from app.ingest import StickerSetTracker
+from app.jobs import enqueue_jobs, message_job, sticker_set_job
+from app.models import Channel
+from app.utils import is_ad_message
+
+CHECKPOINT_INTERVAL = 10
+CHECKPOINT_JOBS = 200
+
+
+class ChannelCrawl:
+    """
+    Crawls a channel from the newest message to the oldest one and enqueues
+    ingestion jobs for workers, checkpointing the range of crawled message ids
+    in the Channel row. Messages are fetched through the userbot account pool.
+
+    A re-run first fetches messages newer than crawl_max_id and then, if the
+    history wasn't finished, resumes below crawl_min_id.
+    """
+
+    def __init__(self, channel_id: int, peer, run_ocr: bool, run_vector: bool):
+        self.channel_id = channel_id
+        # a username, or a PeerChannel only some accounts of the pool can resolve
+        self.peer = peer
+        self._pinned = None
+        self.run_ocr = run_ocr
+        self.run_vector = run_vector
+        self.queued = 0
+        self.sticker_sets = StickerSetTracker()
+        self._jobs: list[dict] = []
+        self._top_id: int | None = None
+        self._last_checkpoint = time.time()
+
+    async def _flush(self, **values):
+        """Enqueue buffered jobs and move the checkpoint in the same transaction"""
+        async with new_session():
+            await enqueue_jobs(self._jobs)
+            if values:
+                await db.session.execute(update(Channel).where(Channel.id == self.channel_id).values(**values))
+        self.queued += len(self._jobs)
+        self._jobs = []
+        self._last_checkpoint = time.time()
+
+    async def _enqueue(self, message: Message):
+        if is_ad_message(message):
+            return
+        if message.photo:
+            self._jobs.append(message_job(self.channel_id, message.id, self.run_ocr, self.run_vector))
+        elif message.sticker:
+            input_sticker_set = next(
+                attr for attr in message.document.attributes if isinstance(attr, DocumentAttributeSticker)
+            ).stickerset
+            set_id = getattr(input_sticker_set, 'id', None)
+            if set_id is not None and not await self.sticker_sets.should_ingest(set_id):
+                return
+            self._jobs.append(sticker_set_job(input_sticker_set, self.run_ocr, self.run_vector))
+
+    async def _crawl_new(self, since_id: int | None):
+        from app.userbot_client import pool
+
+        top_id = None
+        async for message in pool.iter_messages(self.peer, self._pinned, min_id=since_id or 0):
+            top_id = top_id or message.id
+            await self._enqueue(message)
+        # the new range is only contiguous with the crawled one once all of it is enqueued
+        if top_id is not None:
+            self._top_id = top_id
+            await self._flush(crawl_max_id=top_id)
+
+    async def _crawl_history(self, below_id: int | None):
+        from app.userbot_client import pool
+
+        bottom_id = below_id
+        async for message in pool.iter_messages(self.peer, self._pinned, max_id=below_id or 0):
+            self._top_id = self._top_id or message.id
+            await self._enqueue(message)
+            bottom_id = message.id
+            if len(self._jobs) >= CHECKPOINT_JOBS or time.time() - self._last_checkpoint > CHECKPOINT_INTERVAL:
+                await self._flush(crawl_min_id=bottom_id, crawl_max_id=self._top_id)
+        await self._flush(crawl_min_id=bottom_id, crawl_max_id=self._top_id, crawl_complete=True)
+
+    async def run(self):
+        from app.userbot_client import pool
+
+        self._pinned = await pool.account_for(self.peer)
+        async with new_session():
+            channel = await Channel.get(self.channel_id)
+        self._top_id = channel.crawl_max_id
+
+        if channel.crawl_min_id is not None or channel.crawl_complete:
+            await self._crawl_new(channel.crawl_max_id)
+        if not channel.crawl_complete:
+            await self._crawl_history(channel.crawl_min_id)
+
+    def status(self) -> str:
+        return f"Queued {self.queued + len(self._jobs)} jobs"
+
+
+__all__ = ['ChannelCrawl']
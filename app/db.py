@@ -8,6 +8,9 @@ from app.config import config
 
 engine = create_async_engine(
     config.db_url,
+    pool_size=config.db_pool_size,
+    max_overflow=config.db_max_overflow,
+    pool_pre_ping=True,
     json_serializer=lambda obj: json.dumps(obj, ensure_ascii=False),
 )
 _async_session = async_sessionmaker(
@@ -0,0 +1,140 @@
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image as PILImage
+
+from app.config import config
+from app.storage import store
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = config.data_dir / 'derivatives'
+# name -> longest side in pixels
+SIZES = {'thumb': 320, 'medium': 720}
+FORMATS = {'jpg': 'JPEG', 'webp': 'WEBP'}
+QUALITY = 80
+EVICT_INTERVAL = 600
+TEMP_MAX_AGE = 3600
+
+DERIVATIVE_EXECUTOR = ThreadPoolExecutor(2, thread_name_prefix='derivative')
+
+# (phash, size, fmt) -> generation in progress
+_pending: dict[tuple[str, str, str], asyncio.Future[Path]] = {}
+
+
+def derivative_path(phash: str, size: str, fmt: str) -> Path:
+    return DERIVATIVES_DIR / size / f'{phash}.{fmt}'
+
+
+def make_derivative(phash: str, size: str, fmt: str, source: bytes | None = None) -> Path:
+    """Downscale the original (or source bytes of it) and write it atomically"""
+    target_path = derivative_path(phash, size, fmt)
+    if source is None:
+        source = store.read(phash)
+        if source is None:
+            raise FileNotFoundError(f'No image {phash}')
+    image = PILImage.open(io.BytesIO(source))
+    image = image.convert('RGB')
+    image.thumbnail((SIZES[size], SIZES[size]))
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target_path.parent, prefix=f'.{phash}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, FORMATS[fmt], quality=QUALITY)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return target_path
+
+
+async def get_derivative(phash: str, size: str, fmt: str) -> Path:
+    """
+    Path of a cached derivative, generated in the thread pool on first request.
+    Concurrent requests for the same derivative share one generation.
+    """
+    path = derivative_path(phash, size, fmt)
+    try:
+        # eviction goes by mtime, so hits keep a derivative alive
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    key = (phash, size, fmt)
+    if key not in _pending:
+        loop = asyncio.get_running_loop()
+        _pending[key] = loop.run_in_executor(DERIVATIVE_EXECUTOR, make_derivative, phash, size, fmt)
+        _pending[key].add_done_callback(lambda _: _pending.pop(key, None))
+    return await asyncio.shield(_pending[key])
+
+
+def pregenerate_derivatives(phash: str, source: bytes):
+    """Called at ingest for the derivatives listed in config.pregenerate_derivatives"""
+    for name in config.pregenerate_derivatives:
+        size, fmt = name.split('.')
+        if not derivative_path(phash, size, fmt).exists():
+            make_derivative(phash, size, fmt, source)
+
+
+def delete_derivatives(phash: str):
+    """The original was replaced (a thumbnail by the full image), derivatives of the old one are stale"""
+    for size in SIZES:
+        for fmt in FORMATS:
+            derivative_path(phash, size, fmt).unlink(missing_ok=True)
+
+
+def evict_derivatives(max_bytes: int):
+    """
+    Delete least recently used derivatives until the cache fits into max_bytes,
+    along with temporary files left behind by a crash in the middle of make_derivative.
+    """
+    now = time.time()
+    files = []
+    total = 0
+    for path in DERIVATIVES_DIR.glob('*/*.*'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if path.suffix[1:] not in FORMATS:
+            # recent ones are still being written
+            if path.suffix == '.tmp' and now - stat.st_mtime > TEMP_MAX_AGE:
+                path.unlink(missing_ok=True)
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    files.sort()
+    for _, file_size, path in files:
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= file_size
+
+
+async def evict_loop():
+    while True:
+        try:
+            await asyncio.to_thread(evict_derivatives, config.derivatives_max_mb * 1024 * 1024)
+        except Exception:
+            logger.exception('Failed to evict derivatives')
+        await asyncio.sleep(EVICT_INTERVAL)
+
+
+__all__ = [
+    'DERIVATIVES_DIR',
+    'SIZES',
+    'FORMATS',
+    'derivative_path',
+    'make_derivative',
+    'get_derivative',
+    'pregenerate_derivatives',
+    'delete_derivatives',
+    'evict_derivatives',
+    'evict_loop',
+]
@@ -0,0 +1,358 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Generic, TypeVar, Union
+
+from sqlalchemy import func, select, update
+
+from app import db, metrics
+from app.clusters import assign_clusters
+from app.config import config
+from app.derivatives import delete_derivatives, pregenerate_derivatives
+from app.db import new_session
+from app.models.sticker import StickerSet
+from app.phash_index import phash_index
+from app.utils import (
+    StickerData,
+    MessageData,
+    download_to_memory,
+    store_image,
+    process_image,
+    embed_images,
+    pick_photo_size,
+    save_image,
+    save_media_batch,
+    mark_indexed,
+    phash_to_int,
+    noop,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+StageFunc = Callable[[list[T]], Awaitable[list[T]]]
+DoneCallback = Callable[[list[T]], Awaitable[None]]
+ErrorCallback = Callable[[T, Exception], Awaitable[None]]
+
+IngestItem = Union[StickerData, MessageData]
+
+HASH_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+EMB_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# generic pipeline
+# ─────────────────────────────────────────────────────────────────────────────
+@dataclass
+class StageConfig:
+    workers: int = 1
+    batch_size: int = 1
+    # seconds to wait for a batch to fill up before processing a partial one
+    batch_timeout: float = 0
+    queue_size: int = 32
+
+
+class Stage(Generic[T]):
+    """
+    A pool of workers draining a bounded queue in batches.
+    Results are forwarded to the next stage, so a full downstream queue
+    slows this stage down instead of piling up items in memory.
+    """
+
+    def __init__(self, name: str, func: StageFunc, config: StageConfig):
+        self.name = name
+        self.func = func
+        self.config = config
+        self.queue: asyncio.Queue[T] = asyncio.Queue(config.queue_size)
+        self.metrics = metrics.stage(name)
+        self.metrics.queue_depth = self.queue.qsize
+
+    async def _next_batch(self) -> list[T]:
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.batch_timeout
+        while len(batch) < self.config.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self, batch: list[T], on_error: ErrorCallback) -> list[T]:
+        start = time.perf_counter()
+        try:
+            results = await self.func(batch)
+            self.metrics.observe(time.perf_counter() - start, len(batch))
+            return results
+        except Exception as exc:
+            if len(batch) == 1:
+                self.metrics.errors += 1
+                logger.exception('Stage %s failed on %s', self.name, batch[0])
+                await on_error(batch[0], exc)
+                return []
+        # retry one by one, so a single bad item doesn't drop the whole batch
+        results = []
+        for item in batch:
+            results.extend(await self._run([item], on_error))
+        return results
+
+    async def worker(self, pipeline: 'Pipeline[T]'):
+        while True:
+            batch = await self._next_batch()
+            try:
+                results = await self._run(batch, pipeline.on_error)
+                await pipeline.forward(self, results)
+            except Exception:
+                logger.exception('Stage %s failed to forward results', self.name)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+class Pipeline(Generic[T]):
+    def __init__(
+        self,
+        stages: list[Stage[T]],
+        on_done: DoneCallback = noop,
+        on_error: ErrorCallback = noop,
+    ):
+        self.stages = stages
+        self.on_done = on_done
+        self.on_error = on_error
+        self._next = {stage: stages[i + 1] for i, stage in enumerate(stages[:-1])}
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        for stage in self.stages:
+            for _ in range(stage.config.workers):
+                self._tasks.append(asyncio.create_task(stage.worker(self)))
+
+    async def put(self, item: T):
+        await self.stages[0].queue.put(item)
+
+    async def forward(self, stage: Stage[T], items: list[T]):
+        next_stage = self._next.get(stage)
+        if next_stage is None:
+            await self.on_done(items)
+            return
+        for item in items:
+            await next_stage.queue.put(item)
+
+    async def join(self):
+        # every stage forwards its results before marking the input as done,
+        # so once a stage is joined all of its items are in the next queue
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.join()
+        await self.close()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# ingestion stages
+# ─────────────────────────────────────────────────────────────────────────────
+STAGE_CONFIGS = {
+    'download': StageConfig(workers=4),
+    'hash': StageConfig(workers=2, batch_size=8),
+    'ocr': StageConfig(workers=1, batch_size=4),
+    'embed': StageConfig(workers=1, batch_size=16),
+    'persist': StageConfig(workers=1, batch_size=64, batch_timeout=0.5, queue_size=128),
+}
+
+
+async def _in_executor(executor: ThreadPoolExecutor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def download_stage(items: list[IngestItem], client=None) -> list[IngestItem]:
+    for item in items:
+        if item.content is None:
+            thumb = None
+            if config.ingest_mode == 'thumbnail' and isinstance(item, MessageData) and item.media.photo:
+                thumb = pick_photo_size(item.media.photo, config.ingest_thumb_size)
+            item.content = await download_to_memory(item.media, item.client or client, thumb)
+            item.thumbnail = thumb is not None
+            if not item.thumbnail:
+                item.media = None
+                item.client = None
+    return items
+
+
+def _hash_batch(items: list[IngestItem]):
+    for item in items:
+        if item.phash is None:
+            item.phash = store_image(item.content)
+            # a thumbnail is replaced by the original later, derivatives of it would be too blurry
+            if not item.thumbnail:
+                pregenerate_derivatives(item.phash, item.content)
+
+
+async def hash_stage(items: list[IngestItem]) -> list[IngestItem]:
+    await _in_executor(HASH_EXECUTOR, _hash_batch, items)
+    # reposts are common, skip the models for anything already indexed
+    await mark_indexed(items)
+    return items
+
+
+def _ocr_batch(items: list[IngestItem]):
+    for item in items:
+        item.text = process_image(item.content)
+
+
+def _replace_thumbnail(content: bytes, phash: str):
+    save_image(content, phash, True)
+    delete_derivatives(phash)
+
+
+async def _fetch_original(item: IngestItem, client=None):
+    item.content = await download_to_memory(item.media, item.client or client)
+    item.thumbnail = False
+    item.media = None
+    item.client = None
+    await _in_executor(HASH_EXECUTOR, _replace_thumbnail, item.content, item.phash)
+
+
+async def ocr_stage(items: list[IngestItem], client=None) -> list[IngestItem]:
+    todo = [item for item in items if item.run_ocr and not item.has_text]
+    # small text is unreadable on a thumbnail, replace it with the original
+    await asyncio.gather(*[_fetch_original(item, client) for item in todo if item.thumbnail])
+    if todo:
+        await _in_executor(OCR_EXECUTOR, _ocr_batch, todo)
+    return items
+
+
+async def embed_stage(items: list[IngestItem]) -> list[IngestItem]:
+    todo = [item for item in items if item.run_vector and not item.has_embedding]
+    if todo:
+        vecs = await _in_executor(EMB_EXECUTOR, embed_images, [item.content for item in todo])
+        for item, vec in zip(todo, vecs):
+            item.embedding = vec
+    return items
+
+
+async def persist_stage(items: list[IngestItem]) -> list[IngestItem]:
+    # clusters match against images persisted by other processes as well
+    await phash_index.refresh()
+    async with new_session():
+        image_ids = await save_media_batch(items)
+        for ph, image_id in image_ids.items():
+            phash_index.add(image_id, phash_to_int(ph))
+        embeddings = {item.phash: item.embedding for item in items if item.embedding is not None}
+        await assign_clusters({image_id: (ph, embeddings.get(ph)) for ph, image_id in image_ids.items()})
+    for item in items:
+        item.content = None
+        item.media = None
+    return items
+
+
+class StickerSetTracker:
+    """
+    Keeps a crawl from fetching the same sticker set over and over.
+    A set is marked as ingested in the DB once all of its documents are stored,
+    so later crawls skip it as well.
+    """
+
+    def __init__(self):
+        self.seen: set[int] = set()
+        self._pending: dict[int, int] = {}
+        self._failed: set[int] = set()
+
+    async def should_ingest(self, set_id: int) -> bool:
+        if set_id in self.seen:
+            return False
+        self.seen.add(set_id)
+        async with new_session():
+            ingested = await db.fetch_val(
+                select(StickerSet.id).where(StickerSet.id == set_id, StickerSet.ingested_at != None)
+            )
+        return not ingested
+
+    def add(self, set_id: int, count: int):
+        self._pending[set_id] = self._pending.get(set_id, 0) + count
+
+    def _finish(self, items: list[IngestItem]) -> list[int]:
+        finished = []
+        for item in items:
+            if not isinstance(item, StickerData):
+                continue
+            set_id = item.sticker_pack_id
+            self._pending[set_id] -= 1
+            if self._pending[set_id] == 0:
+                del self._pending[set_id]
+                if set_id not in self._failed:
+                    finished.append(set_id)
+        return finished
+
+    @staticmethod
+    async def mark_ingested(set_ids: list[int]):
+        async with new_session():
+            await db.session.execute(
+                update(StickerSet).where(StickerSet.id.in_(set_ids)).values(ingested_at=func.now())
+            )
+
+    async def on_done(self, items: list[IngestItem]):
+        finished = self._finish(items)
+        if finished:
+            await self.mark_ingested(finished)
+
+    async def on_error(self, item: IngestItem):
+        if isinstance(item, StickerData):
+            self._failed.add(item.sticker_pack_id)
+            self._finish([item])
+
+
+def build_ingest_pipeline(
+    client=None,
+    on_done: DoneCallback = noop,
+    on_error: ErrorCallback = noop,
+    configs: dict[str, StageConfig] | None = None,
+) -> Pipeline[IngestItem]:
+    """
+    download -> hash/dedupe -> ocr -> embed -> persist
+    Stages run concurrently, so OCR and embedding work on different items at the same time.
+    Items can opt out of OCR or embedding with run_ocr / run_vector.
+    """
+    configs = {**STAGE_CONFIGS, **(configs or {})}
+    funcs = [
+        ('download', functools.partial(download_stage, client=client)),
+        ('hash', hash_stage),
+        ('ocr', functools.partial(ocr_stage, client=client)),
+        ('embed', embed_stage),
+        ('persist', persist_stage),
+    ]
+    stages = [Stage(name, func, configs[name]) for name, func in funcs]
+    return Pipeline(stages, on_done=on_done, on_error=on_error)
+
+
+__all__ = [
+    'StageConfig',
+    'Stage',
+    'Pipeline',
+    'STAGE_CONFIGS',
+    'OCR_EXECUTOR',
+    'EMB_EXECUTOR',
+    'StickerSetTracker',
+    'build_ingest_pipeline',
+]
@@ -0,0 +1,118 @@
+from datetime import timedelta
+
+from sqlalchemy import case, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+from app.models import IngestJob
+
+MAX_ATTEMPTS = 3
+LEASE = timedelta(minutes=5)
+
+
+def message_job(channel_id: int, message_id: int, run_ocr: bool = True, run_vector: bool = True) -> dict:
+    return {
+        'key': f'message:{channel_id}:{message_id}',
+        'kind': 'message',
+        'payload': {'channel_id': channel_id, 'message_id': message_id, 'ocr': run_ocr, 'vector': run_vector},
+    }
+
+
+def sticker_set_job(input_sticker_set, run_ocr: bool = True, run_vector: bool = True) -> dict:
+    if hasattr(input_sticker_set, 'id'):
+        ref = {'id': input_sticker_set.id, 'access_hash': input_sticker_set.access_hash}
+    else:
+        ref = {'short_name': input_sticker_set.short_name}
+    return {
+        'key': f'sticker_set:{ref.get("id") or ref["short_name"]}',
+        'kind': 'sticker_set',
+        'payload': {**ref, 'ocr': run_ocr, 'vector': run_vector},
+    }
+
+
+async def enqueue_jobs(jobs: list[dict]):
+    """Must be called inside a session, jobs that already exist are ignored"""
+    if jobs:
+        await db.session.execute(insert(IngestJob).values(jobs).on_conflict_do_nothing())
+
+
+async def claim_jobs(limit: int) -> list[IngestJob]:
+    """Must be called inside a session, claimed jobs are leased to the caller"""
+    expired = (IngestJob.status == 'running') & (IngestJob.lease_until < func.now())
+    # jobs that crashed their worker too many times are given up on
+    await db.session.execute(
+        update(IngestJob)
+        .where(expired, IngestJob.attempts >= MAX_ATTEMPTS)
+        .values(status='failed', last_error='lease expired', updated_at=func.now())
+    )
+    claimable = (
+        select(IngestJob.id)
+        .where((IngestJob.status == 'pending') | expired)
+        .order_by(IngestJob.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return await db.fetch_vals(
+        update(IngestJob)
+        .where(IngestJob.id.in_(claimable.scalar_subquery()))
+        .values(
+            status='running',
+            attempts=IngestJob.attempts + 1,
+            lease_until=func.now() + LEASE,
+            updated_at=func.now(),
+        )
+        .returning(IngestJob)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def extend_leases(job_ids: list[int]):
+    if job_ids:
+        await db.session.execute(
+            update(IngestJob)
+            .where(IngestJob.id.in_(job_ids), IngestJob.status == 'running')
+            .values(lease_until=func.now() + LEASE)
+        )
+
+
+async def complete_jobs(job_ids: list[int]):
+    if job_ids:
+        await db.session.execute(
+            update(IngestJob)
+            .where(IngestJob.id.in_(job_ids))
+            .values(status='done', lease_until=None, updated_at=func.now())
+        )
+
+
+async def fail_job(job_id: int, error: str):
+    """Puts the job back to the queue unless it ran out of attempts"""
+    await db.session.execute(
+        update(IngestJob)
+        .where(IngestJob.id == job_id)
+        .values(
+            status=case((IngestJob.attempts >= MAX_ATTEMPTS, 'failed'), else_='pending'),
+            last_error=error,
+            lease_until=None,
+            updated_at=func.now(),
+        )
+    )
+
+
+async def job_counts() -> dict[str, int]:
+    rows = await db.fetch_all(
+        select(IngestJob.status, func.count()).group_by(IngestJob.status)
+    )
+    return dict(rows)
+
+
+__all__ = [
+    'MAX_ATTEMPTS',
+    'message_job',
+    'sticker_set_job',
+    'enqueue_jobs',
+    'claim_jobs',
+    'extend_leases',
+    'complete_jobs',
+    'fail_job',
+    'job_counts',
+]
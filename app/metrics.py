@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Callable
+
+from app.config import config
+
+logger = logging.getLogger(__name__)
+
+METRICS_DIR = config.data_dir / 'metrics'
+EXPORT_INTERVAL = 10
+# snapshots not updated for this long belong to processes that are gone
+STALE_AFTER = 60
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def dict(self) -> dict:
+        return {'counts': self.counts, 'count': self.count, 'sum': self.sum}
+
+
+def quantile(hist: dict, q: float) -> float:
+    """Upper bound of the bucket containing the q-th observation"""
+    target = q * hist['count']
+    seen = 0
+    for bound, count in zip(BUCKETS, hist['counts']):
+        seen += count
+        if count and seen >= target:
+            return bound
+    return 0.0
+
+
+class StageMetrics:
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.errors = 0
+        # seconds per batch
+        self.latency = Histogram()
+        self.queue_depth: Callable[[], int] = lambda: 0
+
+    def observe(self, seconds: float, items: int):
+        self.latency.observe(seconds)
+        self.items += items
+
+    def dict(self) -> dict:
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'queue_depth': self.queue_depth(),
+            'latency': self.latency.dict(),
+        }
+
+
+_stages: dict[str, StageMetrics] = {}
+
+
+def stage(name: str) -> StageMetrics:
+    if name not in _stages:
+        _stages[name] = StageMetrics(name)
+    return _stages[name]
+
+
+def snapshot(process: str) -> dict:
+    return {
+        'process': process,
+        'time': time.time(),
+        'stages': {name: metrics.dict() for name, metrics in _stages.items()},
+    }
+
+
+def _write_snapshot(path: Path, data: dict):
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+async def export_loop(role: str):
+    """Periodically write this process' metrics where the bot and the web app can read them"""
+    METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    process = f'{role}-{socket.gethostname()}-{os.getpid()}'
+    path = METRICS_DIR / f'{process}.json'
+    try:
+        while True:
+            try:
+                await asyncio.to_thread(_write_snapshot, path, snapshot(process))
+            except Exception:
+                logger.exception('Failed to export metrics')
+            await asyncio.sleep(EXPORT_INTERVAL)
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def read_snapshots() -> list[dict]:
+    result = []
+    for path in sorted(METRICS_DIR.glob('*.json')):
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        if time.time() - data['time'] < STALE_AFTER:
+            result.append(data)
+    return result
+
+
+def format_snapshots(snapshots: list[dict]) -> str:
+    lines = []
+    for data in snapshots:
+        lines.append(f"{data['process']} ({time.time() - data['time']:.0f}s ago)")
+        for name, s in data['stages'].items():
+            hist = s['latency']
+            per_item = hist['sum'] / s['items'] if s['items'] else 0
+            lines.append(
+                f"  {name}: {s['queue_depth']} queued, {s['items']} done, {s['errors']} failed, "
+                f"batch p50 {quantile(hist, 0.5):g}s p95 {quantile(hist, 0.95):g}s, {per_item:.3f}s/item"
+            )
+    return '\n'.join(lines) or 'No ingestion processes running'
+
+
+def format_prometheus(snapshots: list[dict]) -> str:
+    lines = [
+        '# TYPE memesearch_ingest_items_total counter',
+        '# TYPE memesearch_ingest_errors_total counter',
+        '# TYPE memesearch_ingest_queue_depth gauge',
+        '# TYPE memesearch_ingest_batch_seconds histogram',
+    ]
+    for data in snapshots:
+        for name, s in data['stages'].items():
+            labels = f'process="{data["process"]}",stage="{name}"'
+            lines.append(f'memesearch_ingest_items_total{{{labels}}} {s["items"]}')
+            lines.append(f'memesearch_ingest_errors_total{{{labels}}} {s["errors"]}')
+            lines.append(f'memesearch_ingest_queue_depth{{{labels}}} {s["queue_depth"]}')
+            hist = s['latency']
+            cumulative = 0
+            for bound, count in zip(BUCKETS, hist['counts']):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'memesearch_ingest_batch_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'memesearch_ingest_batch_seconds_sum{{{labels}}} {hist["sum"]}')
+            lines.append(f'memesearch_ingest_batch_seconds_count{{{labels}}} {hist["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+__all__ = [
+    'Histogram',
+    'StageMetrics',
+    'stage',
+    'snapshot',
+    'export_loop',
+    'read_snapshots',
+    'format_snapshots',
+    'format_prometheus',
+]
@@ -2,3 +2,5 @@ from app.models.channel import *
 from app.models.image import *
 from app.models.sticker import *
 from app.models.image_usage import *
+from app.models.ingest_job import *
+from app.models.backfill import *
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+from app.models.base import Base
+import sqlalchemy as sa
+from sqlalchemy import func
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+class BackfillCheckpoint(Base):
+    """
+    Last image id processed by an interrupted backfill, removed once the backfill completes
+    """
+    __tablename__ = 'backfill_checkpoint'
+    name: Mapped[str] = mapped_column(primary_key=True)
+    last_id: Mapped[int]
+    updated_at: Mapped[datetime] = mapped_column(
+        sa.DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+__all__ = ['BackfillCheckpoint']
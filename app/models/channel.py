@@ -8,6 +8,11 @@ class Channel(Base):
     id: Mapped[int] = mapped_column(sa.BigInteger, primary_key=True)
     name: Mapped[str]
     username: Mapped[str] = mapped_column(unique=True, index=True)
+    # every message in [crawl_min_id, crawl_max_id] has been ingested,
+    # crawl_complete means everything below crawl_min_id was too
+    crawl_min_id: Mapped[int | None]
+    crawl_max_id: Mapped[int | None]
+    crawl_complete: Mapped[bool] = mapped_column(server_default=sa.false())
 
 
 class ChannelMessage(Base):
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Optional
 from pgvector.sqlalchemy import Vector   # new import
 
@@ -10,10 +11,22 @@ class Image(Base):
     __tablename__ = 'image'
     id: Mapped[int] = mapped_column(primary_key=True)
     phash: Mapped[str] = mapped_column(unique=True, index=True)
+    # the same hash as a signed 64 bit integer, for hamming distance search
+    phash_int: Mapped[int | None] = mapped_column(sa.BigInteger)
     tg_ref: Mapped[bytes | None]
+    # file references expire, the sweeper refreshes the oldest ones
+    tg_ref_updated_at: Mapped[datetime | None] = mapped_column(sa.DateTime(timezone=True))
     text: Mapped[str | None]
     embedding: Mapped[Optional[list[float]]] = mapped_column(Vector(1152))
+    # id of the representative image of the near-duplicate cluster, the representative points to itself
+    cluster_id: Mapped[int | None] = mapped_column(sa.ForeignKey('image.id'), index=True)
     __table_args__ = (
+        sa.Index(
+            'ix_image_embedding_hnsw',
+            'embedding',
+            postgresql_using='hnsw',
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+        ),
         sa.Index(
             'ix_search_data_text',
             'text',
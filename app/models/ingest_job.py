@@ -0,0 +1,35 @@
+from datetime import datetime
+
+from app.models.base import Base
+import sqlalchemy as sa
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import Mapped, mapped_column
+
+
+class IngestJob(Base):
+    """
+    Durable unit of ingestion work, claimed by workers with FOR UPDATE SKIP LOCKED
+    """
+    __tablename__ = 'ingest_job'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # deduplicates jobs, e.g. message:<channel_id>:<message_id>
+    key: Mapped[str] = mapped_column(unique=True)
+    kind: Mapped[str]
+    payload: Mapped[dict] = mapped_column(JSONB)
+    status: Mapped[str] = mapped_column(server_default='pending')
+    attempts: Mapped[int] = mapped_column(server_default='0')
+    lease_until: Mapped[datetime | None] = mapped_column(sa.DateTime(timezone=True))
+    last_error: Mapped[str | None]
+    created_at: Mapped[datetime] = mapped_column(
+        sa.DateTime(timezone=True), server_default=func.now()
+    )
+    updated_at: Mapped[datetime] = mapped_column(
+        sa.DateTime(timezone=True), server_default=func.now()
+    )
+    __table_args__ = (
+        sa.Index('ix_ingest_job_status_id', 'status', 'id'),
+    )
+
+
+__all__ = ['IngestJob']
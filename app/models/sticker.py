@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from app.models.base import Base
 import sqlalchemy as sa
 from sqlalchemy.orm import Mapped, mapped_column
@@ -6,12 +8,17 @@ class Sticker(Base):
     __tablename__ = 'sticker'
     id: Mapped[int] = mapped_column(primary_key=True)
     image_id: Mapped[int] = mapped_column(
-        sa.BigInteger, sa.ForeignKey('image.id'), unique=True)
+        sa.BigInteger, sa.ForeignKey('image.id'))
     sticker_pack_id: Mapped[int] = mapped_column(
-        sa.BigInteger, sa.ForeignKey('sticker_set.id'), unique=True
+        sa.BigInteger, sa.ForeignKey('sticker_set.id')
+    )
+    __table_args__ = (
+        sa.UniqueConstraint('image_id', 'sticker_pack_id'),
     )
 
 class StickerSet(Base):
     __tablename__ = 'sticker_set'
     id: Mapped[int] = mapped_column(sa.BigInteger, primary_key=True)
     short_name: Mapped[str]
+    # set once every document of the set has been stored
+    ingested_at: Mapped[datetime | None] = mapped_column(sa.DateTime(timezone=True))
@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import defaultdict
+from itertools import combinations
+from typing import Iterator
+
+import sqlalchemy as sa
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from app.db import engine
+from app.models import Image
+
+# 64 bit phashes are split into CHUNKS substrings: two hashes within distance k
+# have at least one substring within k // CHUNKS of each other (multi-index hashing)
+CHUNKS = 4
+CHUNK_BITS = 64 // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+UINT64_MASK = (1 << 64) - 1
+LOAD_BATCH = 10000
+# ids skipped by a refresh are looked up again for this long, workers commit out of id order
+GAP_TTL = 600
+MAX_GAPS = 10000
+
+
+def _chunks(value: int) -> list[int]:
+    return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+
+def _neighbours(value: int, radius: int) -> Iterator[int]:
+    """All chunk values within the given hamming distance"""
+    for distance in range(radius + 1):
+        for bits in combinations(range(CHUNK_BITS), distance):
+            flipped = value
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class PhashIndex:
+    """
+    In-memory index of image phashes answering "all images within hamming distance k".
+    Loaded from the DB on startup, refresh() picks up images added by other processes.
+    """
+
+    def __init__(self):
+        # phash -> image id
+        self._ids: dict[int, int] = {}
+        self._tables: list[dict[int, list[int]]] = [defaultdict(list) for _ in range(CHUNKS)]
+        self._last_id = 0
+        # id below _last_id not loaded yet -> when it was first missed
+        self._gaps: dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, image_id: int, value: int):
+        value &= UINT64_MASK
+        if value in self._ids:
+            return
+        self._ids[value] = image_id
+        for table, chunk in zip(self._tables, _chunks(value)):
+            table[chunk].append(value)
+
+    def query(self, value: int, max_distance: int) -> list[tuple[int, int]]:
+        """(image id, distance) pairs sorted by distance"""
+        value &= UINT64_MASK
+        radius = max_distance // CHUNKS
+        candidates = set()
+        for table, chunk in zip(self._tables, _chunks(value)):
+            for neighbour in _neighbours(chunk, radius):
+                candidates.update(table.get(neighbour, ()))
+        result = []
+        for candidate in candidates:
+            distance = (candidate ^ value).bit_count()
+            if distance <= max_distance:
+                result.append((self._ids[candidate], distance))
+        result.sort(key=lambda x: x[1])
+        return result
+
+    async def refresh(self):
+        """
+        Load images added since the last refresh.
+        Ids are assigned at insert but committed in any order, so ids skipped
+        over are remembered and looked up again until GAP_TTL has passed.
+        """
+        async with self._lock:
+            now = time.monotonic()
+            self._gaps = {
+                image_id: missed_at for image_id, missed_at in self._gaps.items() if now - missed_at < GAP_TTL
+            }
+            condition = Image.id > self._last_id
+            if self._gaps:
+                # one array parameter, an IN list would bind every id separately
+                gaps = sa.literal(list(self._gaps), ARRAY(sa.Integer))
+                condition = or_(condition, Image.id == sa.any_(gaps))
+            async with engine.connect() as conn:
+                result = await conn.stream(
+                    select(Image.id, Image.phash_int)
+                    .where(condition)
+                    .order_by(Image.id)
+                    .execution_options(yield_per=LOAD_BATCH)
+                )
+                async for rows in result.partitions():
+                    for image_id, value in rows:
+                        self._gaps.pop(image_id, None)
+                        if image_id > self._last_id:
+                            # holes before the first load are old rollbacks and conflicts, not commits in flight
+                            if self._last_id:
+                                self._gaps.update(dict.fromkeys(range(self._last_id + 1, image_id), now))
+                            self._last_id = image_id
+                        if value is not None:
+                            self.add(image_id, value)
+            if len(self._gaps) > MAX_GAPS:
+                # ids are mostly missed because of rollbacks and conflicting inserts, keep the newest
+                self._gaps = dict(sorted(self._gaps.items())[-MAX_GAPS:])
+
+
+phash_index = PhashIndex()
+
+
+__all__ = ['PhashIndex', 'phash_index']
@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+
+from app.config import SESSIONS_DIR
+from app.userbot_client import create_client
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Log in an extra userbot account used for crawling')
+    parser.add_argument(
+        'name',
+        help='Session name, the session is stored in data_dir/sessions/<name>.session. '
+             'Sessions directly in that directory are used by the bot, '
+             'give a worker its own with e.g. worker1/<name> and --sessions',
+    )
+    args = parser.parse_args()
+
+    session_file = SESSIONS_DIR / f'{args.name}.session'
+    session_file.parent.mkdir(parents=True, exist_ok=True)
+    client = create_client(str(session_file))
+    await client.start()
+    me = await client.get_me()
+    print(f'Logged in as {me.username or me.id}')
+    await client.disconnect()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
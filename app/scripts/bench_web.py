@@ -0,0 +1,63 @@
+import argparse
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def _worker(url: str, headers: dict, deadline: float, results: list):
+    parts = urlsplit(url)
+    conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    conn = conn_class(parts.netloc)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    count = 0
+    statuses = {}
+    latencies = []
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.monotonic() - started)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        count += 1
+    conn.close()
+    results.append((count, statuses, latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure requests per second of the web app')
+    parser.add_argument('url', help='e.g. http://127.0.0.1:8000/<phash>.jpg')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of keep-alive connections')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run')
+    parser.add_argument('--etag', help='Send If-None-Match with this ETag to measure 304s')
+    args = parser.parse_args()
+
+    headers = {'If-None-Match': args.etag} if args.etag else {}
+    deadline = time.monotonic() + args.duration
+    results = []
+    threads = [
+        threading.Thread(target=_worker, args=(args.url, headers, deadline, results))
+        for _ in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = sum(count for count, _, _ in results)
+    statuses = {}
+    for _, worker_statuses, _ in results:
+        for status, count in worker_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    latencies = sorted(latency for _, _, worker_latencies in results for latency in worker_latencies)
+    print(f'{total / args.duration:.0f} req/s, statuses {statuses}')
+    if latencies:
+        print(
+            f'latency p50 {latencies[len(latencies) // 2] * 1000:.1f}ms '
+            f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -2,28 +2,140 @@ import argparse
 import asyncio
 import json
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional
 
-import easyocr
+import torch
 from sqlalchemy import select
 from tqdm import tqdm
 
-from app.db import new_session, session, fetch_val
+from app import db
+from app.db import new_session
+from app.ingest import Pipeline, Stage, StageConfig, persist_stage
 from app.models.channel import ChannelMessage
+from app.phash_index import phash_index
 from app.config import IMAGES_DIR
-from app.utils import get_or_create_channel, process_image, get_or_create_image
+from app.utils import (
+    MessageData,
+    get_or_create_channel,
+    process_image,
+    embed_image,
+    calculate_phash,
+    save_image,
+    mark_indexed,
+)
+
+CHUNK_SIZE = 1 << 20
+MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+SEPARATOR = re.compile(r'[\s,]*')
+
+pool: ProcessPoolExecutor
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# streaming export reader
+# ─────────────────────────────────────────────────────────────────────────────
+def read_export(result_file: Path) -> tuple[dict, Iterator[dict]]:
+    """
+    Parse result.json without loading it whole: returns the channel fields
+    that precede the messages array and an iterator over the messages
+    """
+    f = open(result_file, 'r', encoding='utf-8')
+    buf = ''
+    while not (match := MESSAGES_KEY.search(buf)):
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError('No messages found in result.json')
+        buf += chunk
+    header = json.loads(buf[:match.start()].rstrip().rstrip(',') + '}')
+
+    def messages():
+        decoder = json.JSONDecoder()
+        data, pos = buf, match.end()
+        with f:
+            while True:
+                pos = SEPARATOR.match(data, pos).end()
+                if data.startswith(']', pos):
+                    return
+                try:
+                    message, pos = decoder.raw_decode(data, pos)
+                except json.JSONDecodeError:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        raise
+                    data, pos = data[pos:] + chunk, 0
+                    continue
+                yield message
+
+    return header, messages()
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# process pool
+# ─────────────────────────────────────────────────────────────────────────────
+def _init_worker(threads: int):
+    torch.set_num_threads(threads)
+
+
+def _hash_file(photo_path: str) -> str:
+    with open(photo_path, 'rb') as f:
+        data = f.read()
+    ph = calculate_phash(data)
+    save_image(data, ph)
+    return ph
+
+
+def _analyze_file(photo_path: str, run_ocr: bool, run_vector: bool) -> tuple[str | None, list[float] | None]:
+    text = process_image(photo_path) if run_ocr else None
+    vec = embed_image(photo_path) if run_vector else None
+    return text, vec
+
+
+async def _in_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+# stages
+# ─────────────────────────────────────────────────────────────────────────────
+async def skip_stage(items: list[MessageData]) -> list[MessageData]:
+    """Drop messages linked by a previous run, this is what makes imports resumable"""
+    async with new_session():
+        existing = set(await db.fetch_vals(
+            select(ChannelMessage.message_id).where(
+                ChannelMessage.channel_id == items[0].channel_id,
+                ChannelMessage.message_id.in_([item.message_id for item in items]),
+            )
+        ))
+    return [item for item in items if item.message_id not in existing]
+
+
+async def hash_stage(items: list[MessageData]) -> list[MessageData]:
+    phashes = await asyncio.gather(*[_in_pool(_hash_file, str(item.file_path)) for item in items])
+    for item, ph in zip(items, phashes):
+        item.phash = ph
+    await mark_indexed(items)
+    return items
+
+
+async def analyze_stage(items: list[MessageData]) -> list[MessageData]:
+    for item in items:
+        run_ocr = item.run_ocr and not item.has_text
+        run_vector = item.run_vector and not item.has_embedding
+        if run_ocr or run_vector:
+            item.text, item.embedding = await _in_pool(_analyze_file, str(item.file_path), run_ocr, run_vector)
+    return items
 
 
-async def import_from_json(base_dir: Path, ocr_result_path: Optional[str] = None):
+async def import_from_json(base_dir: Path, workers: int, ocr_result_path: Optional[str] = None, channel_username: Optional[str] = None):
     """Import data from Telegram JSON export"""
-    # Find and load the result.json file
     result_file = base_dir / 'result.json'
     if not result_file.exists():
         raise FileNotFoundError(f'Could not find result.json in {base_dir}')
 
-    with open(result_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    header, messages = read_export(result_file)
 
     # Load optional OCR results file if provided
     ocr_results = {}
@@ -33,63 +145,70 @@ async def import_from_json(base_dir: Path, ocr_result_path: Optional[str] = None
             ocr_results = {item['name']: item['text'] for item in ocr_result_data}
 
     # Extract channel info
-    channel_id = data.get('id')
-    channel_name = data.get('name')
-    channel_username = input('Channel username: ')
-
+    channel_id = header.get('id')
+    channel_name = header.get('name')
     if not channel_id or not channel_name:
         raise ValueError('Invalid channel data in JSON file')
+    channel_username = channel_username or input('Channel username: ')
 
-    # Get or create channel
-    channel = await get_or_create_channel(channel_id, channel_name, channel_username)
-
-    # Process messages
-    for message in tqdm(data.get('messages', [])):
-        # Skip messages without photos
-        if 'photo' not in message:
-            continue
-
-        photo_path = str(base_dir / message['photo'])
-        if not os.path.exists(photo_path):
-            print(f'Warning: Photo {photo_path} does not exist, skipping.')
-            continue
-
-        # Get OCR result from provided file or generate using OCR
-        photo_name = Path(message['photo']).name
-        ocr_text = ocr_results.get(photo_name) if ocr_results else None
-
-        # Process image
-        image_phash, text = process_image(photo_path, ocr_text)
-
-        # Get or create image record
-        image = await get_or_create_image(image_phash, text)
-
-        # Link image to channel
-        message_id = message.get('id')
-
-        # Check if the link already exists to avoid duplicates
-        existing = await fetch_val(
-            select(ChannelMessage).where(
-                ChannelMessage.channel_id == channel.id,
-                ChannelMessage.message_id == message_id,
-            )
-        )
-
-        if not existing:
-            channel_image = ChannelMessage(
-                channel_id=channel.id, image_id=image.id, message_id=message_id
-            )
-            session.add(channel_image)
+    async with new_session():
+        channel = await get_or_create_channel(channel_id, channel_name, channel_username)
+    # reposts of already stored images join their clusters
+    await phash_index.refresh()
+
+    progress = tqdm(desc='Imported', unit='msg')
+
+    async def on_done(items):
+        progress.update(len(items))
+
+    async def on_error(item, exc):
+        print(f'Error importing message {item.message_id}: {exc}')
+
+    # every persisted batch is committed on its own, so an interrupted import keeps its progress
+    pipeline = Pipeline([
+        Stage('skip', skip_stage, StageConfig(batch_size=256, batch_timeout=0.5, queue_size=512)),
+        Stage('hash', hash_stage, StageConfig(workers=2, batch_size=workers * 2, queue_size=256)),
+        Stage('analyze', analyze_stage, StageConfig(workers=workers, queue_size=workers * 4)),
+        Stage('persist', persist_stage, StageConfig(batch_size=256, batch_timeout=1, queue_size=512)),
+    ], on_done=on_done, on_error=on_error)
+
+    async with pipeline:
+        for message in messages:
+            # Skip messages without photos
+            if 'photo' not in message:
+                continue
+
+            photo_path = base_dir / message['photo']
+            if not photo_path.exists():
+                print(f'Warning: Photo {photo_path} does not exist, skipping.')
+                continue
+
+            # Get OCR result from provided file or generate using OCR
+            ocr_text = ocr_results.get(photo_path.name)
+            await pipeline.put(MessageData(
+                file_path=photo_path,
+                channel_id=channel.id,
+                message_id=message['id'],
+                text=ocr_text,
+                run_ocr=ocr_text is None,
+            ))
+    progress.close()
 
     print(f'Successfully imported channel {channel_name} (ID: {channel_id})')
 
 
 async def main():
+    global pool
+
     parser = argparse.ArgumentParser(description='Import Telegram channel data')
     parser.add_argument(
         'base_dir', help='Path to the directory containing result.json and photos'
     )
     parser.add_argument('--ocr-result', help='Optional path to OCR results JSON file')
+    parser.add_argument('--username', help='Channel username, asked interactively if omitted')
+    parser.add_argument(
+        '--workers', type=int, default=2, help='Number of processes running OCR and embedding'
+    )
 
     args = parser.parse_args()
 
@@ -98,8 +217,9 @@ async def main():
 
     base_dir = Path(args.base_dir)
 
-    async with new_session():
-        await import_from_json(base_dir, args.ocr_result)
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+    with ProcessPoolExecutor(args.workers, initializer=_init_worker, initargs=(threads,)) as pool:
+        await import_from_json(base_dir, args.workers, args.ocr_result, args.username)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,56 @@
+import argparse
+import asyncio
+from pathlib import Path
+
+from sqlalchemy import select
+from tqdm import tqdm
+
+from app import db
+from app.config import IMAGES_DIR
+from app.db import new_session
+from app.models import Image
+from app.segments import SegmentStore
+from app.storage import file_store, iter_legacy_images
+
+
+def pack(segment_store: SegmentStore):
+    """Move every image from the file layout into segments, readers fall back to the files meanwhile"""
+    paths = iter_legacy_images()
+    sharded = IMAGES_DIR.glob('*/*/*.jpg')
+    for path in tqdm([*paths, *sharded], desc='Packed', unit='img'):
+        phash = Path(path).stem
+        data = file_store.read(phash)
+        if data is None:
+            continue
+        segment_store.write(phash, data)
+        Path(path).unlink(missing_ok=True)
+
+
+async def compact(segment_store: SegmentStore, min_garbage: float):
+    async with new_session():
+        referenced = set(await db.fetch_vals(select(Image.phash)))
+    freed = await asyncio.to_thread(segment_store.compact, referenced, min_garbage)
+    print(f'Freed {freed / 1024 / 1024:.1f} MiB')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Manage the packed segment image store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('pack', help='Move images from IMAGES_DIR into segments')
+    compact_parser = subparsers.add_parser(
+        'compact', help='Rewrite segments holding mostly overwritten or unreferenced images, run it periodically'
+    )
+    compact_parser.add_argument(
+        '--min-garbage', type=float, default=0.5, help='Share of dead bytes that makes a segment worth rewriting'
+    )
+    args = parser.parse_args()
+
+    segment_store = SegmentStore(fallback=file_store)
+    if args.command == 'pack':
+        await asyncio.to_thread(pack, segment_store)
+    else:
+        await compact(segment_store, args.min_garbage)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+import argparse
+
+from tqdm import tqdm
+
+from app.storage import iter_legacy_images, migrate_image
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Move images from the flat IMAGES_DIR layout into shard directories. '
+                    'Safe to run while the bot and workers are running, reads fall back to the old location.'
+    )
+    parser.parse_args()
+
+    moved = 0
+    for legacy_path in tqdm(iter_legacy_images(), desc='Moved', unit='img'):
+        migrate_image(legacy_path)
+        moved += 1
+    print(f'Moved {moved} images')
+
+
+if __name__ == '__main__':
+    main()
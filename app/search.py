@@ -0,0 +1,159 @@
+import asyncio
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import sqlalchemy as sa
+from sqlalchemy import func, select
+
+from app import db
+from app.clusters import is_representative
+from app.models import Image
+from app.models.image_usage import ImageUsage
+from app.utils import embed_image, embed_text
+
+PAGE_SIZE = 10
+MAX_DISTANCE = 0.7
+MAX_SIMILAR_QUERIES = 1000
+# the HNSW index returns at most hnsw.ef_search rows before the representative filter,
+# which drops near-duplicates: scan this many times the rows a page needs
+EF_SEARCH_FACTOR = 4
+# pgvector's upper limit
+MAX_EF_SEARCH = 1000
+# images sent for reverse search are kept until their embedding is needed
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# separate from the ingestion and backfill executors, so searches don't wait behind their batches
+QUERY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query')
+
+# popular queries are typed over and over, and scrolling repeats the query for every page
+_embed_text = functools.lru_cache(maxsize=1024)(embed_text)
+
+# token -> image sent for reverse search, replaced by its embedding once it is used, oldest first
+_similar_queries: OrderedDict[str, bytes | asyncio.Future[list[float]]] = OrderedDict()
+
+
+async def text_embedding(query: str) -> list[float]:
+    return await asyncio.get_running_loop().run_in_executor(QUERY_EXECUTOR, _embed_text, query)
+
+
+async def image_embedding(data: bytes) -> list[float]:
+    """Embedding of an image sent for reverse search"""
+    return await asyncio.get_running_loop().run_in_executor(QUERY_EXECUTOR, embed_image, data)
+
+
+def _pending_bytes() -> int:
+    return sum(len(entry) for entry in _similar_queries.values() if isinstance(entry, bytes))
+
+
+def remember_image(data: bytes) -> str:
+    """
+    Keep an uploaded image for paginated similarity search, returns its token.
+    The embedding is only computed if the token is used.
+    """
+    token = uuid4().hex
+    _similar_queries[token] = data
+    while len(_similar_queries) > MAX_SIMILAR_QUERIES or _pending_bytes() > MAX_PENDING_BYTES:
+        _similar_queries.popitem(last=False)
+    return token
+
+
+async def recall_embedding(token: str) -> list[float] | None:
+    """None if the token expired, pages of the same search share one embedding"""
+    entry = _similar_queries.get(token)
+    if entry is None:
+        return None
+    if isinstance(entry, bytes):
+        entry = _similar_queries[token] = asyncio.ensure_future(image_embedding(entry))
+    try:
+        return await asyncio.shield(entry)
+    except Exception:
+        # expired from now on, the user is asked to send the image again
+        _similar_queries.pop(token, None)
+        raise
+
+
+# all queries below must be called inside a session
+
+async def search(query: str, offset: int = 0, limit: int = PAGE_SIZE) -> list[Image]:
+    """Cluster representatives ranked by the closer of text and embedding distance"""
+    qvec = await text_embedding(query)
+
+    emb_dist = func.greatest(
+        sa.cast(Image.embedding.op('<=>')(qvec), sa.Float) - 0.8, 0.0
+    ).label('emb_dist')
+    txt_dist = Image.text.op('<->>')(query).label('txt_dist')
+
+    dist = sa.case(
+        (Image.embedding == None, txt_dist),
+        (Image.text == None, emb_dist),
+        else_=func.least(emb_dist, txt_dist),
+    ).label('dist')
+
+    return list(await db.fetch_vals(
+        select(Image).where(dist < MAX_DISTANCE, is_representative()).order_by(dist).limit(limit).offset(offset)
+    ))
+
+
+def usage_counts():
+    """Subquery of image_id, usage_count for every image used at least once"""
+    return (
+        select(
+            ImageUsage.image_id.label('image_id'),
+            func.count(ImageUsage.id).label('usage_count'),
+        )
+        .group_by(ImageUsage.image_id)
+        .subquery()
+    )
+
+
+async def most_used(offset: int = 0, limit: int = PAGE_SIZE) -> list[Image]:
+    usage_count_q = usage_counts()
+    return list(await db.fetch_vals(
+        select(Image)
+        .join(usage_count_q, usage_count_q.c.image_id == Image.id)
+        .order_by(usage_count_q.c.usage_count.desc())
+        .limit(limit)
+        .offset(offset)
+    ))
+
+
+async def similar(
+    embedding: list[float], offset: int = 0, limit: int = PAGE_SIZE, exclude: tuple[int, ...] = ()
+) -> list[Image]:
+    """Cluster representatives by cosine distance to embedding"""
+    ef_search = min(max(40, (offset + limit) * EF_SEARCH_FACTOR), MAX_EF_SEARCH)
+    # local to the session's transaction
+    await db.session.execute(select(func.set_config('hnsw.ef_search', str(ef_search), True)))
+    return list(await db.fetch_vals(
+        select(Image)
+        .where(Image.embedding != None, is_representative(), Image.id.notin_(exclude))
+        .order_by(Image.embedding.op('<=>')(embedding))
+        .limit(limit)
+        .offset(offset)
+    ))
+
+
+async def similar_to_image(image_id: int, offset: int = 0, limit: int = PAGE_SIZE) -> list[Image] | None:
+    """None if the image doesn't exist or has no embedding"""
+    row = await db.fetch_one(select(Image.embedding, Image.cluster_id).where(Image.id == image_id))
+    if row is None or row.embedding is None:
+        return None
+    # the image itself and its own representative would always come first
+    exclude = (image_id,) if row.cluster_id is None else (image_id, row.cluster_id)
+    return await similar(row.embedding, offset, limit, exclude)
+
+
+__all__ = [
+    'PAGE_SIZE',
+    'text_embedding',
+    'image_embedding',
+    'remember_image',
+    'recall_embedding',
+    'search',
+    'most_used',
+    'usage_counts',
+    'similar',
+    'similar_to_image',
+]
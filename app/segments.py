@@ -0,0 +1,220 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from app.config import config
+
+SEGMENTS_DIR = config.data_dir / 'segments'
+SEGMENT_SIZE = 1 << 30
+# phash, offset and length of a record, appended to <segment>.idx after the bytes are on disk
+ENTRY = struct.Struct('<16sQI')
+# a lookup miss re-reads the index files at most this often, unless nothing was written at all
+MIN_REFRESH_INTERVAL = 0.1
+# the lock file mtime may not change between two quick writes, so refresh anyway after this long
+MAX_REFRESH_INTERVAL = 5
+
+
+class SegmentStore:
+    """
+    Appends image bytes to large segment files instead of one file per image.
+    Each segment has an index file of fixed size entries, the last entry of
+    a phash wins, so overwriting is an append as well.
+
+    Any number of processes can read and write: appends are serialized with
+    flock and readers pick up entries written by others on a lookup miss.
+    Writers touch the lock file, so misses skip re-reading the index while nothing changed.
+    Images not found here are read from the fallback store, which keeps
+    reads working while images are being packed.
+    """
+
+    def __init__(self, directory: Path = SEGMENTS_DIR, segment_size: int = SEGMENT_SIZE, fallback=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fallback = fallback
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # phash -> (segment, offset, length)
+        self._index: dict[str, tuple[int, int, int]] = {}
+        # segment -> bytes of its index file already loaded
+        self._loaded: dict[int, int] = {}
+        self._maps: dict[int, mmap.mmap] = {}
+        # guards the index and the maps, reads of mapped bytes don't take it
+        self._lock = threading.RLock()
+        self._refreshed_at = 0.0
+        self._refreshed_stamp = None
+
+    def _segment_path(self, segment: int) -> Path:
+        return self.directory / f'{segment:06d}.seg'
+
+    def _index_path(self, segment: int) -> Path:
+        return self.directory / f'{segment:06d}.idx'
+
+    @property
+    def _lock_path(self) -> Path:
+        return self.directory / 'lock'
+
+    def _stamp(self) -> int | None:
+        try:
+            return os.stat(self._lock_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _segments(self) -> list[int]:
+        return sorted(int(path.stem) for path in self.directory.glob('*.seg'))
+
+    def _drop(self, segment: int):
+        self._loaded.pop(segment, None)
+        if segment in self._maps:
+            self._maps.pop(segment).close()
+
+    def refresh(self):
+        """Load index entries appended since the last refresh"""
+        with self._lock:
+            # taken before reading, a write landing meanwhile triggers another refresh
+            self._refreshed_stamp = self._stamp()
+            self._refreshed_at = time.monotonic()
+            segments = self._segments()
+            if set(self._loaded) - set(segments):
+                # a segment was compacted away, its entries may be gone for good
+                for segment in list(self._loaded):
+                    self._drop(segment)
+                self._index.clear()
+            for segment in segments:
+                loaded = self._loaded.get(segment, 0)
+                try:
+                    if os.stat(self._index_path(segment)).st_size == loaded:
+                        continue
+                    with open(self._index_path(segment), 'rb') as f:
+                        f.seek(loaded)
+                        data = f.read()
+                except FileNotFoundError:
+                    continue
+                # an entry may be half written
+                data = data[:len(data) - len(data) % ENTRY.size]
+                for phash, offset, length in ENTRY.iter_unpack(data):
+                    self._index[phash.decode()] = (segment, offset, length)
+                self._loaded[segment] = loaded + len(data)
+
+    def _refresh_on_miss(self):
+        """Misses are common (404s, images still in the fallback store), most of them skip the refresh"""
+        since = time.monotonic() - self._refreshed_at
+        if since < MIN_REFRESH_INTERVAL:
+            return
+        if since < MAX_REFRESH_INTERVAL and self._stamp() == self._refreshed_stamp:
+            return
+        self.refresh()
+
+    def _locate(self, phash: str) -> tuple[int, int, int] | None:
+        location = self._index.get(phash)
+        if location is None:
+            self._refresh_on_miss()
+            location = self._index.get(phash)
+        elif time.monotonic() - self._refreshed_at > MAX_REFRESH_INTERVAL and self._stamp() != self._refreshed_stamp:
+            # hits see overwrites and compactions by other processes within MAX_REFRESH_INTERVAL
+            self.refresh()
+            location = self._index.get(phash)
+        return location
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        """Segments grow, remap when the record is past the mapped part"""
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            with open(self._segment_path(segment), 'rb') as f:
+                new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if segment_map is not None:
+                segment_map.close()
+            self._maps[segment] = segment_map = new_map
+        return segment_map
+
+    def exists(self, phash: str) -> bool:
+        if self._locate(phash) is not None:
+            return True
+        return self.fallback is not None and self.fallback.exists(phash)
+
+    def path(self, phash: str) -> Path | None:
+        """Images in segments have no file of their own"""
+        if self._locate(phash) is not None or self.fallback is None:
+            return None
+        return self.fallback.path(phash)
+
+    def _read_at(self, location: tuple[int, int, int]) -> bytes:
+        segment, offset, length = location
+        with self._lock:
+            segment_map = self._map(segment, offset + length)
+        return segment_map[offset:offset + length]
+
+    def read(self, phash: str) -> bytes | None:
+        location = self._locate(phash)
+        if location is not None:
+            try:
+                return self._read_at(location)
+            except (FileNotFoundError, ValueError):
+                # compacted by another process, ValueError if a refresh noticing that closed the map
+                self.refresh()
+                location = self._index.get(phash)
+                if location is not None:
+                    return self._read_at(location)
+        if self.fallback is not None:
+            return self.fallback.read(phash)
+        return None
+
+    def write(self, phash: str, data: bytes, overwrite: bool = False):
+        if not overwrite and self._locate(phash) is not None:
+            return
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            segment = max(self._segments(), default=0)
+            segment_path = self._segment_path(segment)
+            size = segment_path.stat().st_size if segment_path.exists() else 0
+            if size and size + len(data) > self.segment_size:
+                segment += 1
+                segment_path = self._segment_path(segment)
+            with open(segment_path, 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+                f.flush()
+                # the index entry must never point at bytes that aren't there after a crash
+                os.fsync(f.fileno())
+            with open(self._index_path(segment), 'ab') as f:
+                f.write(ENTRY.pack(phash.encode(), offset, len(data)))
+            os.utime(self._lock_path)
+        with self._lock:
+            self._index[phash] = (segment, offset, len(data))
+
+    def compact(self, referenced: set[str], min_garbage: float = 0.5) -> int:
+        """
+        Rewrite sealed segments where at least min_garbage of the bytes are
+        overwritten or unreferenced images, returns the number of bytes freed
+        """
+        self.refresh()
+        freed = 0
+        # the last segment is still being appended to
+        for segment in self._segments()[:-1]:
+            with self._lock:
+                live = [
+                    phash for phash, (seg, _, _) in self._index.items()
+                    if seg == segment and phash in referenced
+                ]
+            live_bytes = sum(self._index[phash][2] for phash in live)
+            size = self._segment_path(segment).stat().st_size
+            if not size or live_bytes > size * (1 - min_garbage):
+                continue
+            for phash in live:
+                self.write(phash, self.read(phash), overwrite=True)
+            with open(self._lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._index_path(segment).unlink(missing_ok=True)
+                self._segment_path(segment).unlink(missing_ok=True)
+                os.utime(self._lock_path)
+            with self._lock:
+                self._drop(segment)
+                for phash in [phash for phash, (seg, _, _) in self._index.items() if seg == segment]:
+                    del self._index[phash]
+            freed += size - live_bytes
+        return freed
+
+
+__all__ = ['SEGMENTS_DIR', 'SegmentStore']
@@ -0,0 +1,122 @@
+import os
+import tempfile
+from pathlib import Path
+
+from app.config import IMAGES_DIR, config
+from app.segments import SegmentStore
+
+# IMAGES_DIR/ab/cd/abcd....jpg keeps every directory small
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+
+def image_path(phash: str) -> Path:
+    """Where an image is written"""
+    shards = [phash[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_DEPTH)]
+    return IMAGES_DIR.joinpath(*shards, f'{phash}.jpg')
+
+
+def legacy_image_path(phash: str) -> Path:
+    """Flat layout used before sharding, still read until migrate_images() has moved everything"""
+    return IMAGES_DIR / f'{phash}.jpg'
+
+
+def resolve_image(phash: str) -> Path | None:
+    """Path of a stored image, None if there is none"""
+    path = image_path(phash)
+    if path.exists():
+        return path
+    legacy_path = legacy_image_path(phash)
+    if legacy_path.exists():
+        return legacy_path
+    # moved by the migration between the two checks
+    return path if path.exists() else None
+
+
+def _fsync_dir(path: Path):
+    """Makes a rename into the directory durable"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class FileStore:
+    """One file per image in shard directories"""
+
+    def exists(self, phash: str) -> bool:
+        return resolve_image(phash) is not None
+
+    def path(self, phash: str) -> Path | None:
+        return resolve_image(phash)
+
+    def read(self, phash: str) -> bytes | None:
+        path = resolve_image(phash)
+        try:
+            return path.read_bytes() if path else None
+        except FileNotFoundError:
+            return None
+
+    def write(self, phash: str, data: bytes, overwrite: bool = False):
+        """
+        The file is written under a temporary name and renamed, so readers
+        never see a partially written image.
+        """
+        existing_path = resolve_image(phash)
+        if existing_path and not overwrite:
+            return
+        target_path = image_path(phash)
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        # temporary files stay in the top directory, where cleanup_temp_images looks for them
+        fd, tmp_path = tempfile.mkstemp(dir=IMAGES_DIR, prefix=f'.{phash}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                # the path is content-addressed and never rewritten, it must not survive a crash empty
+                os.fsync(f.fileno())
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        _fsync_dir(target_path.parent)
+        if existing_path and existing_path != target_path:
+            existing_path.unlink(missing_ok=True)
+
+
+file_store = FileStore()
+# every image read and write goes through this, config.image_store picks the backend
+store: FileStore | SegmentStore = (
+    SegmentStore(fallback=file_store) if config.image_store == 'segments' else file_store
+)
+
+
+def migrate_image(legacy_path: Path) -> Path:
+    target_path = image_path(legacy_path.stem)
+    target_path.parent.mkdir(parents=True, exist_ok=True)
+    if target_path.exists():
+        # written by ingestion in the meantime
+        legacy_path.unlink(missing_ok=True)
+    else:
+        os.replace(legacy_path, target_path)
+    return target_path
+
+
+def iter_legacy_images():
+    with os.scandir(IMAGES_DIR) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.jpg') and not entry.name.startswith('.'):
+                yield Path(entry.path)
+
+
+__all__ = [
+    'FileStore',
+    'file_store',
+    'store',
+    'image_path',
+    'legacy_image_path',
+    'resolve_image',
+    'migrate_image',
+    'iter_legacy_images',
+]
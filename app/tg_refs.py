@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import re
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+
+import sqlalchemy as sa
+from sqlalchemy import func, select, update
+from telethon import TelegramClient
+from telethon.errors import FileReferenceExpiredError, FileReferenceInvalidError, FloodWaitError, RPCError
+from telethon.tl.functions.messages import UploadMediaRequest
+from telethon.tl.types import (
+    Document,
+    InputDocument,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaPhotoExternal,
+    InputMediaUploadedPhoto,
+    InputPeerSelf,
+    InputPhoto,
+    Photo,
+)
+
+from app import db
+from app.clusters import is_representative
+from app.config import config
+from app.db import new_session
+from app.derivatives import get_derivative
+from app.models import Image
+from app.search import usage_counts
+from app.storage import store
+
+logger = logging.getLogger(__name__)
+
+PREWARM_BATCH = 50
+PREWARM_IDLE = 60
+SWEEP_BATCH = 200
+SWEEP_INTERVAL = 3600
+# FILE_REFERENCE_3_EXPIRED names the broken item, telethon has no class for it
+# and keeps the code in .message; the plain code maps to the error classes below
+FILE_REFERENCE_ERROR = re.compile(r'FILE_REFERENCE_(\d+)_(?:EXPIRED|INVALID)')
+FILE_REFERENCE_ERRORS = (FileReferenceExpiredError, FileReferenceInvalidError)
+
+
+def pack_file_ref(file: InputPhoto | Photo | InputDocument | Document) -> bytes:
+    type_ = 1 if isinstance(file, (Photo, InputPhoto)) else 2
+    return struct.pack('>Hqq', type_, file.id, file.access_hash) + file.file_reference
+
+
+def unpack_file_ref(file_ref: bytes) -> InputPhoto | InputDocument:
+    type_, id_, access_hash = struct.unpack('>Hqq', file_ref[:2 + 8 + 8])
+    file_ref = file_ref[2 + 8 + 8:]
+    if type_ == 1:
+        return InputPhoto(id_, access_hash, file_ref)
+    elif type_ == 2:
+        return InputDocument(id_, access_hash, file_ref)
+
+
+async def upload_image(client: TelegramClient, image: Image) -> Photo:
+    """
+    Store the config.inline_derivative of the image on telegram without sending it to any chat.
+    Telegram fetches it from external_url itself, in debug mode the bot uploads it.
+    """
+    if not await asyncio.to_thread(store.exists, image.phash):
+        raise FileNotFoundError(f'No image {image.phash}')
+    size, fmt = config.inline_derivative.split('.')
+    if config.debug:
+        path = await get_derivative(image.phash, size, fmt)
+        media = InputMediaUploadedPhoto(await client.upload_file(path))
+    else:
+        media = InputMediaPhotoExternal(f'{config.external_url}/{size}/{image.phash}.{fmt}')
+    result = await client(UploadMediaRequest(InputPeerSelf(), media))
+    return result.photo
+
+
+def is_file_reference_error(exc: RPCError) -> bool:
+    return isinstance(exc, FILE_REFERENCE_ERRORS) or bool(FILE_REFERENCE_ERROR.search(exc.message or ''))
+
+
+def stale_ref_images(exc: RPCError, images: list[Image]) -> list[Image]:
+    """Images whose cached tg_ref caused exc, all cached ones if telegram doesn't say which"""
+    if not is_file_reference_error(exc):
+        return []
+    match = FILE_REFERENCE_ERROR.search(exc.message or '')
+    if match and int(match.group(1)) < len(images):
+        images = [images[int(match.group(1))]]
+    return [image for image in images if image.tg_ref]
+
+
+async def clear_refs(image_ids: list[int]):
+    """Must be called inside a session, updates loaded Image objects as well"""
+    await db.session.execute(
+        update(Image).where(Image.id.in_(image_ids)).values(tg_ref=None, tg_ref_updated_at=None)
+    )
+
+
+async def refresh_ref(client: TelegramClient, image: Image) -> bytes:
+    """
+    Re-send the cached file to telegram, which returns it with a fresh file reference.
+    Falls back to uploading the stored file if the reference is already dead.
+    """
+    file = unpack_file_ref(image.tg_ref)
+    media = InputMediaPhoto(file) if isinstance(file, InputPhoto) else InputMediaDocument(file)
+    try:
+        result = await client(UploadMediaRequest(InputPeerSelf(), media))
+        return pack_file_ref(result.photo if isinstance(file, InputPhoto) else result.document)
+    except RPCError as exc:
+        if not is_file_reference_error(exc):
+            raise
+    return pack_file_ref(await upload_image(client, image))
+
+
+async def save_refs(refs: dict[int, bytes]):
+    """Store tg_refs by image id with a single UPDATE ... FROM (VALUES ...)"""
+    values = sa.values(
+        sa.column('id', sa.Integer), sa.column('tg_ref', sa.LargeBinary), name='v'
+    ).data(list(refs.items()))
+    try:
+        async with new_session():
+            await db.session.execute(
+                update(Image)
+                .where(Image.id == values.c.id)
+                .values(tg_ref=values.c.tg_ref, tg_ref_updated_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+    except Exception:
+        logger.exception('Failed to save tg_refs of images %s', list(refs))
+
+
+class UploadRegistry:
+    """
+    Single-flight uploads: concurrent inline queries showing the same fresh image
+    wait for one upload instead of uploading it once each.
+    An entry is kept until its ref is saved, so queries in between don't upload again.
+    """
+
+    def __init__(self):
+        self._uploads: dict[int, asyncio.Future[bytes]] = {}
+        self._saving: set[int] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def get_ref(self, client: TelegramClient, image: Image) -> asyncio.Future[bytes]:
+        if image.id not in self._uploads:
+            self._uploads[image.id] = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self._upload(client, image))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return self._uploads[image.id]
+
+    async def get_refs(self, client: TelegramClient, images: list[Image]) -> dict[int, bytes]:
+        """tg_refs by image id, images that fail to upload are left out"""
+        refs = {image.id: image.tg_ref for image in images if image.tg_ref}
+        missing = [image for image in images if not image.tg_ref]
+        results = await asyncio.gather(
+            *[asyncio.shield(self.get_ref(client, image)) for image in missing], return_exceptions=True
+        )
+        for image, result in zip(missing, results):
+            if isinstance(result, BaseException):
+                logger.warning('Failed to upload image %s: %r', image.id, result)
+            else:
+                refs[image.id] = result
+        return refs
+
+    async def save(self, refs: dict[int, bytes]):
+        """
+        Persist uploaded refs with one save_refs and drop their entries once it has landed.
+        Refs another caller already saves are skipped, so a shared upload is written once.
+        """
+        refs = {
+            image_id: ref for image_id, ref in refs.items()
+            if image_id in self._uploads and image_id not in self._saving
+        }
+        if not refs:
+            return
+        self._saving.update(refs)
+        try:
+            await save_refs(refs)
+        finally:
+            for image_id in refs:
+                self._saving.discard(image_id)
+                self._uploads.pop(image_id, None)
+
+    def forget(self, image_ids):
+        """Drop refs that won't be saved, e.g. the answer showing them failed"""
+        for image_id in image_ids:
+            if image_id not in self._saving:
+                self._uploads.pop(image_id, None)
+
+    async def _upload(self, client: TelegramClient, image: Image):
+        future = self._uploads[image.id]
+        try:
+            future.set_result(pack_file_ref(await upload_image(client, image)))
+        except Exception as exc:
+            future.set_exception(exc)
+            # retrieved here so that nobody waiting doesn't produce a warning
+            future.exception()
+            del self._uploads[image.id]
+
+
+uploads = UploadRegistry()
+
+
+class RateLimiter:
+    """Spaces out requests of every loop sharing it to rate per second in total"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        delay = self._next - now
+        self._next = max(now, self._next) + 1 / self.rate
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """After a flood wait, telegram wants every loop to back off"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+# prewarming and the sweep share config.prewarm_rate
+background_limiter = RateLimiter(config.prewarm_rate or 1)
+
+
+async def _prewarm_candidates(exclude: set[int]) -> list[Image]:
+    """Images without a tg_ref, most used first, then newest"""
+    usage_count_q = usage_counts()
+    return await db.fetch_vals(
+        select(Image)
+        .outerjoin(usage_count_q, usage_count_q.c.image_id == Image.id)
+        .where(Image.tg_ref == None, is_representative(), Image.id.notin_(exclude))
+        .order_by(usage_count_q.c.usage_count.desc().nulls_last(), Image.id.desc())
+        .limit(PREWARM_BATCH)
+    )
+
+
+async def prewarm_loop(client: TelegramClient):
+    """
+    Upload images ahead of time so that inline answers reuse a cached tg_ref
+    instead of making telegram fetch external_url during the query.
+    Together with the sweep limited to config.prewarm_rate uploads per second.
+    """
+    # images whose upload failed, e.g. the file is missing, retried after a restart
+    failed: set[int] = set()
+    while True:
+        try:
+            async with new_session():
+                images = await _prewarm_candidates(failed)
+            if not images:
+                await asyncio.sleep(PREWARM_IDLE)
+                continue
+            for image in images:
+                await background_limiter.wait()
+                try:
+                    # shared with inline queries showing the same image right now
+                    tg_ref = await asyncio.shield(uploads.get_ref(client, image))
+                except FloodWaitError as exc:
+                    background_limiter.pause(exc.seconds)
+                    continue
+                except Exception:
+                    logger.exception('Failed to upload image %s', image.id)
+                    failed.add(image.id)
+                    continue
+                await uploads.save({image.id: tg_ref})
+        except Exception:
+            logger.exception('tg_ref prewarming failed')
+            await asyncio.sleep(PREWARM_IDLE)
+
+
+async def sweep_loop(client: TelegramClient):
+    """Refresh the oldest tg_refs before telegram expires them, shares the rate limit of prewarming"""
+    while True:
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(hours=config.tg_ref_max_age_hours)
+            async with new_session():
+                images = await db.fetch_vals(
+                    select(Image)
+                    .where(Image.tg_ref != None, sa.or_(Image.tg_ref_updated_at == None, Image.tg_ref_updated_at < cutoff))
+                    .order_by(Image.tg_ref_updated_at.asc().nulls_first())
+                    .limit(SWEEP_BATCH)
+                )
+            for image in images:
+                await background_limiter.wait()
+                try:
+                    tg_ref = await refresh_ref(client, image)
+                except FloodWaitError as exc:
+                    background_limiter.pause(exc.seconds)
+                    continue
+                except Exception:
+                    logger.exception('Failed to refresh tg_ref of image %s', image.id)
+                    async with new_session():
+                        await clear_refs([image.id])
+                    continue
+                await save_refs({image.id: tg_ref})
+            if len(images) < SWEEP_BATCH:
+                await asyncio.sleep(SWEEP_INTERVAL)
+        except Exception:
+            logger.exception('tg_ref sweep failed')
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+
+__all__ = [
+    'pack_file_ref',
+    'unpack_file_ref',
+    'upload_image',
+    'is_file_reference_error',
+    'stale_ref_images',
+    'clear_refs',
+    'refresh_ref',
+    'save_refs',
+    'UploadRegistry',
+    'uploads',
+    'RateLimiter',
+    'background_limiter',
+    'prewarm_loop',
+    'sweep_loop',
+]
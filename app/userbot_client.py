@@ -1,22 +1,25 @@
+import fcntl
 import os
 import platform
 import subprocess
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 from sqlalchemy import select
 from telethon import TelegramClient
 
+from app.accounts import AccountPool
 from app.bot_client import NewMessage
 from app.config import config
-from app.config import USERBOT_SESSION_FILE
+from app.config import SESSIONS_DIR, USERBOT_SESSION_FILE
 from app.db import new_session
+from app.jobs import enqueue_jobs, message_job
 from app.models import Channel
 from app import db
-from app.utils import download_to_path, process_media_message
+from app.utils import is_ad_message
 
 
-def create_client():
+def create_client(session_file: str = str(USERBOT_SESSION_FILE)):
     device_model = None
     if sys.platform == 'linux':
         if os.path.isfile('/sys/devices/virtual/dmi/id/product_name'):
@@ -36,7 +39,7 @@ def create_client():
         )
 
     client = TelegramClient(
-        str(USERBOT_SESSION_FILE),
+        session_file,
         config.api_id,
         config.api_hash,
         device_model=device_model,
@@ -47,21 +50,86 @@ def create_client():
     client.parse_mode = 'html'
     return client
 
-client = create_client()
+# the bot process's main account, see get_client
+_client: TelegramClient | None = None
 
-OCR_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# open lock files of the sessions this process uses, closing one releases its lock
+_session_locks = []
 
-#listen to new messages
-@client.on(NewMessage())
+
+def lock_session(session_file) -> None:
+    """
+    A telethon session can't be used by two processes at once: its SQLite file gets locked
+    and telegram drops duplicated auth keys. Fails if another process already uses it.
+    """
+    lock_file = open(f'{session_file}.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f'Session {session_file} is used by another process')
+    _session_locks.append(lock_file)
+
+# the main account and the extra sessions given to start_pool
+pool = AccountPool()
+
+
+async def start_pool(main_client: TelegramClient, session_files=None) -> AccountPool:
+    """
+    session_files defaults to the sessions directly in SESSIONS_DIR, which belong to the bot process.
+    Every process needs its own subset, a session is locked by the process using it.
+    """
+    pool.add(Path(main_client.session.filename).stem, main_client)
+    if session_files is None:
+        session_files = sorted(SESSIONS_DIR.glob('*.session'))
+    for session_file in session_files:
+        lock_session(session_file)
+        extra = create_client(str(session_file))
+        await extra.connect()
+        if not await extra.is_user_authorized():
+            print(f"Session {session_file.name} is not authorized, skipping")
+            await extra.disconnect()
+            continue
+        pool.add(Path(session_file).stem, extra)
+    return pool
+
+# ids of channels whose new posts are ingested, kept in memory so that
+# messages from other chats are dropped without touching the DB
+tracked_channels: set[int] = set()
+
+
+async def load_tracked_channels():
+    async with new_session():
+        channel_ids = await db.fetch_vals(select(Channel.id))
+    tracked_channels.clear()
+    tracked_channels.update(channel_ids)
+
+
+def track_channel(channel_id: int):
+    tracked_channels.add(channel_id)
+
+
+#listen to new messages, registered by get_client
 async def on_new_message(event: NewMessage.Event):
-    print(f"New message in {event.chat.id}")
     if not event.is_channel or event.message.photo is None:
         return
+    channel_id = event.message.peer_id.channel_id
+    if channel_id not in tracked_channels or is_ad_message(event.message):
+        return
+    # handled by the same ingestion workers as crawls
     async with new_session():
-        channel = await db.fetch_val(select(Channel).where(Channel.id == event.chat.id))
-        if not channel:
-            return
-    path, ph = await download_to_path(event.message)
-    await process_media_message(path, ph, channel.id, event.message.id, OCR_EXECUTOR)
+        await enqueue_jobs([message_job(channel_id, event.message.id)])
     #logging
-    print(f"Downloaded {event.message.id} from {channel.name} ({channel.username})")
\ No newline at end of file
+    print(f"Queued {event.message.id} from {channel_id}")
+
+
+def get_client() -> TelegramClient:
+    """
+    The main userbot account of the bot process, created on first use:
+    workers import this module too and must not open its session file.
+    """
+    global _client
+    if _client is None:
+        _client = create_client()
+        _client.add_event_handler(on_new_message, NewMessage())
+    return _client
@@ -1,25 +1,26 @@
-import asyncio
-import shutil
-import tempfile
-from dataclasses import dataclass
+import io
+import time
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Counter, Optional, Union
+from typing import Any, Counter, Optional, Union
 
 import cv2
 import easyocr
+import numpy as np
 import torch
 import open_clip
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.dialects.postgresql import insert
 from PIL import Image as PILImage
 from imagehash import phash
-from telethon.tl.types import MessageEntityTextUrl
+from telethon.tl.types import MessageEntityTextUrl, Photo
 
 from app import db
 from app.bot_client import Message
-from app.db import session, fetch_val, new_session
+from app.db import session, new_session
 from app.models import Channel, Image, ChannelMessage, Sticker
 from app.config import IMAGES_DIR
+from app.storage import store
 
 # ── OCR ──────────────────────────────────────────────────────────────────────
 eocr = easyocr.Reader(["ru", "en"])
@@ -43,15 +44,25 @@ _MODEL.eval().to(_DEVICE)
 tokenizer = open_clip.get_tokenizer('hf-hub:timm/ViT-SO400M-16-SigLIP2-384')
 print(tokenizer)
 
+# images are passed around either as a path or as the downloaded bytes
+ImageSource = Union[str, bytes]
+
+def open_image(image: ImageSource) -> PILImage.Image:
+    return PILImage.open(io.BytesIO(image) if isinstance(image, bytes) else image)
+
 @torch.no_grad()
-def embed_image(path: str) -> list[float]:
-    img = _PREP(PILImage.open(path)).unsqueeze(0).to(_DEVICE)
+def embed_images(images: list[ImageSource]) -> list[list[float]]:
+    """Encode a batch of images in a single forward pass."""
+    imgs = torch.stack([_PREP(open_image(image)) for image in images]).to(_DEVICE)
     if _DEVICE.type == "cuda":
         with torch.cuda.amp.autocast():
-            vec = _MODEL.encode_image(img)
+            vecs = _MODEL.encode_image(imgs)
     else:
-        vec = _MODEL.encode_image(img)
-    return vec.squeeze().cpu().tolist()  # 512-d vector
+        vecs = _MODEL.encode_image(imgs)
+    return vecs.cpu().tolist()
+
+def embed_image(image: ImageSource) -> list[float]:
+    return embed_images([image])[0]
 
 @torch.no_grad()
 def embed_text(text: str) -> list[float]:
@@ -74,72 +85,110 @@ def embed_text(text: str) -> list[float]:
 # ─────────────────────────────────────────────────────────────────────────────
 # download
 # ─────────────────────────────────────────────────────────────────────────────
-async def download_to_path(media) -> tuple[Path, str]:
-    from app.userbot_client import client
-    with tempfile.NamedTemporaryFile(delete_on_close=False) as fp:
-        await client.download_media(media, fp)
-        fp.close()
-        ph = calculate_phash(fp.name)
-        return save_image(fp.name, ph), ph
+async def download_to_memory(media, client=None, thumb=None) -> bytes:
+    from app.userbot_client import get_client, pool
+
+    client = client or get_client()
+    account = pool.account_of(client)
+    if account is None:
+        # not part of a started pool, e.g. in a script
+        return await client.download_media(media, bytes, thumb=thumb)
+    # file references only work for this account, so its flood waits are waited out
+    return await pool.call(lambda account_client: account_client.download_media(media, bytes, thumb=thumb), account)
+
+def pick_photo_size(photo: Photo, min_size: int) -> str | None:
+    """
+    Type of the smallest downscaled size of a photo covering min_size, None if only the original does.
+    download_media takes the type: it ignores size objects other than PhotoSize, e.g. PhotoSizeProgressive.
+    """
+    sizes = sorted((size for size in photo.sizes if getattr(size, 'w', None)), key=lambda size: size.w * size.h)
+    # the largest size is the original
+    for size in sizes[:-1]:
+        if min(size.w, size.h) >= min_size:
+            return size.type
+    return None
+
+def store_image(data: bytes) -> str:
+    """Write downloaded bytes into the image store under their phash"""
+    ph = calculate_phash(data)
+    save_image(data, ph)
+    return ph
 
 # ─────────────────────────────────────────────────────────────────────────────
 # dataclasses
 # ─────────────────────────────────────────────────────────────────────────────
-@dataclass
-class StickerData:
-    file_path: Path
-    phash: str
+@dataclass(kw_only=True)
+class MediaData:
+    media: Any = field(default=None, repr=False)
+    # account that fetched media, file references are only valid for it
+    client: Any = field(default=None, repr=False)
+    content: bytes | None = field(default=None, repr=False)
+    # content is a downscaled telegram thumbnail, media is kept to fetch the original
+    thumbnail: bool = False
+    file_path: Path | None = None
+    phash: str | None = None
+    text: str | None = field(default=None, repr=False)
+    embedding: list[float] | None = field(default=None, repr=False)
+    run_ocr: bool = True
+    run_vector: bool = True
+    # already stored for this phash, no need to compute again
+    has_text: bool = False
+    has_embedding: bool = False
+    job_id: int | None = None
+
+@dataclass(kw_only=True)
+class StickerData(MediaData):
     sticker_pack_id: int
 
-@dataclass
-class MessageData:
-    file_path: Path
-    phash: str
+@dataclass(kw_only=True)
+class MessageData(MediaData):
     channel_id: int
     message_id: int
 
 # ─────────────────────────────────────────────────────────────────────────────
-# main processor
+# persistence
 # ─────────────────────────────────────────────────────────────────────────────
-async def process_media_message(
-    data: Union[StickerData, MessageData],
-    OCR_EXECUTOR,
-    EMB_EXECUTOR,
-    run_ocr: bool = True, run_vector: bool = True,
-):
-    loop = asyncio.get_running_loop()
-
-    # OCR text (CPU)
-    text = None
-    if run_ocr:
-        text = await loop.run_in_executor(OCR_EXECUTOR, process_image, str(data.file_path))
-
+async def save_media_batch(items: list[Union[StickerData, MessageData]]) -> dict[str, int]:
+    """
+    Upsert images and link them to their sources with one statement per table,
+    must be called inside a session. Returns image ids by phash.
+    """
+    rows: dict[str, dict] = {}
+    for item in items:
+        row = rows.setdefault(item.phash, {
+            'phash': item.phash, 'phash_int': phash_to_int(item.phash), 'text': None, 'embedding': None,
+        })
+        if not row['text'] and item.text is not None:
+            row['text'] = item.text
+        if row['embedding'] is None and item.embedding is not None:
+            row['embedding'] = item.embedding
 
-    vec = None
-    if run_vector:
-        vec = await loop.run_in_executor(EMB_EXECUTOR, embed_image, str(data.file_path))
+    # a single statement can't update the same row twice, hence the merge above
+    stmt = insert(Image).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Image.phash],
+        set_={
+            'text': func.coalesce(func.nullif(Image.text, ''), stmt.excluded.text, Image.text),
+            'embedding': func.coalesce(Image.embedding, stmt.excluded.embedding),
+        },
+    ).returning(Image.phash, Image.id)
+    image_ids = dict((await db.session.execute(stmt)).all())
 
-    async with new_session():
-        img = await get_or_create_image(data.phash, text, vec)
-
-        if isinstance(data, MessageData):
-            await db.session.execute(
-                insert(ChannelMessage)
-                .values(
-                    channel_id=data.channel_id,
-                    image_id=img.id,
-                    message_id=data.message_id,
-                )
-                .on_conflict_do_nothing()
-            )
-        elif isinstance(data, StickerData):
-            await db.session.execute(
-                insert(Sticker)
-                .values(image_id=img.id, sticker_pack_id=data.sticker_pack_id)
-                .on_conflict_do_nothing()
-            )
-        else:
-            raise TypeError(f"Unknown item type: {type(data)}")
+    messages = [
+        {'channel_id': item.channel_id, 'message_id': item.message_id, 'image_id': image_ids[item.phash]}
+        for item in items if isinstance(item, MessageData)
+    ]
+    stickers = [
+        {'sticker_pack_id': item.sticker_pack_id, 'image_id': image_ids[item.phash]}
+        for item in items if isinstance(item, StickerData)
+    ]
+    if len(messages) + len(stickers) != len(items):
+        raise TypeError(f"Unknown item types: {[type(item) for item in items]}")
+    if messages:
+        await db.session.execute(insert(ChannelMessage).values(messages).on_conflict_do_nothing())
+    if stickers:
+        await db.session.execute(insert(Sticker).values(stickers).on_conflict_do_nothing())
+    return image_ids
 
 # ─────────────────────────────────────────────────────────────────────────────
 # misc helpers (unchanged)
@@ -152,18 +201,29 @@ async def get_or_create_channel(id_: int, title: str, username: str) -> Channel:
         await session.flush()
     return channel
 
-def calculate_phash(image_path: str) -> str:
-    return str(phash(PILImage.open(image_path)))
+def calculate_phash(image: ImageSource) -> str:
+    return str(phash(open_image(image)))
+
+def phash_to_int(image_phash: str) -> int:
+    """Hex phash as a signed 64 bit integer, the way postgres stores bigint"""
+    value = int(image_phash, 16)
+    return value - (1 << 64) if value >= 1 << 63 else value
 
-def save_image(image_path: str, phash: str) -> Path:
-    """Save image to the IMAGES_DIR with its phash as filename"""
-    target_path = IMAGES_DIR / f'{phash}.jpg'
-    if not target_path.exists():
-        shutil.copy(image_path, target_path)
-    return target_path
+def save_image(data: bytes, phash: str, overwrite: bool = False):
+    """Save image to the image store with its phash as key"""
+    store.write(phash, data, overwrite)
+
+def cleanup_temp_images(max_age: float = 3600):
+    """Remove temporary files left behind by a crash in the middle of save_image"""
+    for path in IMAGES_DIR.glob('.*.tmp'):
+        try:
+            if time.time() - path.stat().st_mtime > max_age:
+                path.unlink()
+        except FileNotFoundError:
+            pass
 
 def process_image(
-    photo_path: str, ocr_result: Optional[str] = None
+    photo: ImageSource, ocr_result: Optional[str] = None
 ) -> str:
     """Process an image file and return its hash and text content"""
     # Ensure images directory exists
@@ -174,7 +234,11 @@ def process_image(
         return ocr_result
 
     # Convert image for OCR
-    image_cv2 = cv2.cvtColor(cv2.imread(photo_path), cv2.COLOR_BGR2RGB)
+    if isinstance(photo, bytes):
+        image_cv2 = cv2.imdecode(np.frombuffer(photo, np.uint8), cv2.IMREAD_COLOR)
+    else:
+        image_cv2 = cv2.imread(photo)
+    image_cv2 = cv2.cvtColor(image_cv2, cv2.COLOR_BGR2RGB)
 
     # Run OCR
     ocr_result = eocr.readtext(image_cv2)
@@ -183,22 +247,24 @@ def process_image(
     return ocr_text
 
 
-async def get_or_create_image(image_phash: str, text: str | None, embedding: list[float] | None) -> Image:
-    image = await fetch_val(select(Image).where(Image.phash == image_phash))
-    if not image:
-        image = Image(phash=image_phash, text=text, embedding=embedding)
-        session.add(image)
-        await session.flush()
-    if image.embedding is None and embedding:
-        image.embedding = embedding
-        await session.flush()
-    if not image.text and text:
-        image.text = text
-        await session.flush()
-    return image
+async def mark_indexed(items: list[MediaData]):
+    """Look up already stored images by phash, so OCR and embedding are only run for missing data"""
+    phashes = {item.phash for item in items}
+    async with new_session():
+        rows = await db.fetch_all(
+            select(Image.phash, Image.text != None, Image.embedding != None)
+            .where(Image.phash.in_(phashes))
+        )
+    indexed = {ph: (has_text, has_embedding) for ph, has_text, has_embedding in rows}
+    for item in items:
+        item.has_text, item.has_embedding = indexed.get(item.phash, (False, False))
 
 
 def is_ad_message(message: Message) -> bool:
     links = Counter(x.url for x in (message.entities or []) if isinstance(x, MessageEntityTextUrl))
     top_link_count = links.most_common(1)[0][1] if links else 0
     return top_link_count >= 2
+
+
+async def noop(*_args):
+    """Default for optional async callbacks"""
@@ -1,16 +1,136 @@
-from fastapi import FastAPI
-from fastapi.responses import FileResponse
+import asyncio
+import os
+import re
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse, Response
 import uvicorn
 
-from app.config import IMAGES_DIR, config
+from app import metrics, search
+from app.config import config
+from app.db import new_session
+from app.models import Image
+from app.derivatives import FORMATS, SIZES, evict_loop, get_derivative
+from app.storage import store
+
+PHASH_RE = re.compile(r'[0-9a-f]{16}')
+# files are content-addressed by phash and never change
+CACHE_HEADERS = {'Cache-Control': 'public, max-age=31536000, immutable'}
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    evict_task = asyncio.create_task(evict_loop())
+    yield
+    evict_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def _image_json(image: Image) -> dict:
+    return {
+        'id': image.id,
+        'url': f'{config.external_url}/{image.phash}.jpg',
+        'thumb_url': f'{config.external_url}/thumb/{image.phash}.webp',
+        'text': image.text,
+    }
+
+
+def _page(images: list[Image], offset: int) -> dict:
+    next_cursor = str(offset + len(images)) if len(images) == search.PAGE_SIZE else None
+    return {'results': [_image_json(image) for image in images], 'next_cursor': next_cursor}
+
+
+def _offset(cursor: str | None) -> int:
+    if not cursor:
+        return 0
+    if not cursor.isdigit():
+        raise HTTPException(400, 'Invalid cursor')
+    return int(cursor)
+
+
+@app.get('/search')
+async def get_search(q: str = '', cursor: str | None = None):
+    """The inline search as JSON, the cursor is next_cursor of the previous page"""
+    offset = _offset(cursor)
+    query = q.strip()
+    async with new_session():
+        if query:
+            images = await search.search(query, offset)
+        else:
+            images = await search.most_used(offset)
+    return _page(images, offset)
+
+
+@app.get('/similar/{image_id}')
+async def get_similar(image_id: int, cursor: str | None = None):
+    offset = _offset(cursor)
+    async with new_session():
+        images = await search.similar_to_image(image_id, offset)
+    if images is None:
+        raise HTTPException(404)
+    return _page(images, offset)
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    snapshots = await asyncio.to_thread(metrics.read_snapshots)
+    return metrics.format_prometheus(snapshots)
+
+
+def not_modified(request: Request, etag: str) -> Response | None:
+    """304 if the client already has this version, checked before touching the disk"""
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers={**CACHE_HEADERS, 'ETag': etag})
+    return None
+
+
+def serve_immutable(path: Path, etag: str, media_type: str) -> Response:
+    """GET/HEAD of a content-addressed file, 404 without a second stat"""
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(404)
+    return FileResponse(
+        path, stat_result=stat_result, media_type=media_type, headers={**CACHE_HEADERS, 'ETag': etag}
+    )
 
 
-app = FastAPI()
+@app.api_route('/{phash}.jpg', methods=['GET', 'HEAD'])
+async def get_file(request: Request, phash: str):
+    # also rejects anything that could escape the images directory
+    if not PHASH_RE.fullmatch(phash):
+        raise HTTPException(404)
+    etag = f'"{phash}"'
+    if response := not_modified(request, etag):
+        return response
+    # standalone files are sent with sendfile, packed images with a single read from the segment map
+    path = store.path(phash)
+    if path is not None:
+        return serve_immutable(path, etag, 'image/jpeg')
+    data = await asyncio.to_thread(store.read, phash)
+    if data is None:
+        raise HTTPException(404)
+    return Response(data, media_type='image/jpeg', headers={**CACHE_HEADERS, 'ETag': etag})
 
 
-@app.get('/{phash}.jpg')
-async def get_file(phash: str):
-    return FileResponse(IMAGES_DIR / f'{phash}.jpg')
+@app.api_route('/{size}/{phash}.{fmt}', methods=['GET', 'HEAD'])
+async def get_derivative_file(request: Request, size: str, phash: str, fmt: str):
+    if size not in SIZES or fmt not in FORMATS or not PHASH_RE.fullmatch(phash):
+        raise HTTPException(404)
+    etag = f'"{phash}-{size}-{fmt}"'
+    if response := not_modified(request, etag):
+        return response
+    if not store.exists(phash):
+        raise HTTPException(404)
+    path = await get_derivative(phash, size, fmt)
+    return serve_immutable(path, etag, f'image/{FORMATS[fmt].lower()}')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import glob
+import logging
+from collections import defaultdict
+from pathlib import Path
+
+from sqlalchemy.dialects.postgresql import insert
+from telethon.tl.functions.messages import GetStickerSetRequest
+from telethon.tl.types import InputStickerSetID, InputStickerSetShortName, PeerChannel
+
+from app import db, metrics
+from app.accounts import AccountPool
+from app.config import SESSION_FILE, SESSIONS_DIR, USERBOT_SESSION_FILE
+from app.db import new_session
+from app.ingest import IngestItem, StickerSetTracker, build_ingest_pipeline
+from app.jobs import LEASE, claim_jobs, complete_jobs, extend_leases, fail_job
+from app.models import Channel, IngestJob
+from app.models.sticker import StickerSet
+from app.phash_index import phash_index
+from app.utils import MessageData, StickerData, cleanup_temp_images
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5
+MAX_IN_FLIGHT = 64
+# animated (TGS) and video stickers, the pipeline only decodes still images
+UNSUPPORTED_STICKER_MIME_TYPES = frozenset({'application/x-tgsticker', 'video/webm'})
+
+
+class IngestWorker:
+    """
+    Claims jobs from the ingest_job table and runs them through the ingestion pipeline.
+    Any number of workers, in any number of processes, can share the queue.
+    """
+
+    def __init__(self, pool: AccountPool, max_in_flight: int = MAX_IN_FLIGHT):
+        self.pool = pool
+        self.max_in_flight = max_in_flight
+        self.pipeline = build_ingest_pipeline(on_done=self._on_done, on_error=self._on_error)
+        self.sticker_sets = StickerSetTracker()
+        # job id -> number of pipeline items not finished yet
+        self._in_flight: dict[int, int] = {}
+        self._peers = {}
+
+    async def _finish(self, job_ids: list[int]):
+        for job_id in job_ids:
+            self._in_flight.pop(job_id, None)
+        async with new_session():
+            await complete_jobs(job_ids)
+
+    async def _on_done(self, items: list[IngestItem]):
+        await self.sticker_sets.on_done(items)
+        await self._complete_items(items)
+
+    async def _complete_items(self, items: list[IngestItem]):
+        finished = []
+        for item in items:
+            if item.job_id not in self._in_flight:
+                continue  # already failed
+            self._in_flight[item.job_id] -= 1
+            if self._in_flight[item.job_id] == 0:
+                finished.append(item.job_id)
+        if finished:
+            await self._finish(finished)
+
+    async def _on_error(self, item: IngestItem, exc: Exception):
+        await self.sticker_sets.on_error(item)
+        if isinstance(item, StickerData):
+            # one broken sticker doesn't fail the rest of its set,
+            # the set isn't marked as ingested so a later crawl retries it
+            await self._complete_items([item])
+        elif item.job_id in self._in_flight:
+            await self._fail(item.job_id, exc)
+
+    async def _fail(self, job_id: int, exc: Exception):
+        self._in_flight.pop(job_id, None)
+        async with new_session():
+            await fail_job(job_id, f'{type(exc).__name__}: {exc}')
+
+    async def _peer(self, channel_id: int):
+        """
+        Username where possible, access hashes differ between accounts.
+        Channels without one are pinned to an account that has them cached.
+        """
+        if channel_id not in self._peers:
+            async with new_session():
+                channel = await Channel.get(channel_id)
+            peer = channel.username if channel and channel.username else PeerChannel(channel_id)
+            self._peers[channel_id] = peer, await self.pool.account_for(peer)
+        return self._peers[channel_id]
+
+    async def _message_items(self, channel_id: int, jobs: list[IngestJob]) -> list[tuple[IngestJob, list[IngestItem]]]:
+        ids = [job.payload['message_id'] for job in jobs]
+        peer, pinned = await self._peer(channel_id)
+
+        async def get_messages(client):
+            return client, await client.get_messages(await client.get_input_entity(peer), ids=ids)
+
+        client, messages = await self.pool.call(get_messages, pinned)
+        result = []
+        for job, message in zip(jobs, messages):
+            items = []
+            # the message may have been deleted or edited since it was crawled
+            if message is not None and message.photo:
+                items.append(MessageData(
+                    media=message,
+                    client=client,
+                    channel_id=channel_id,
+                    message_id=message.id,
+                    run_ocr=job.payload['ocr'],
+                    run_vector=job.payload['vector'],
+                    job_id=job.id,
+                ))
+            result.append((job, items))
+        return result
+
+    async def _sticker_set_items(self, job: IngestJob) -> list[IngestItem]:
+        if 'id' in job.payload:
+            input_sticker_set = InputStickerSetID(job.payload['id'], job.payload['access_hash'])
+        else:
+            input_sticker_set = InputStickerSetShortName(job.payload['short_name'])
+
+        async def get_sticker_set(client):
+            return client, await client(GetStickerSetRequest(input_sticker_set, 0))
+
+        client, sticker_set = await self.pool.call(get_sticker_set)
+        async with new_session():
+            await db.session.execute(insert(StickerSet).values(
+                id=sticker_set.set.id,
+                short_name=sticker_set.set.short_name,
+            ).on_conflict_do_nothing())
+        documents = [
+            document for document in sticker_set.documents
+            if document.mime_type not in UNSUPPORTED_STICKER_MIME_TYPES
+        ]
+        if not documents:
+            await self.sticker_sets.mark_ingested([sticker_set.set.id])
+            return []
+        self.sticker_sets.add(sticker_set.set.id, len(documents))
+        return [
+            StickerData(
+                media=document,
+                client=client,
+                sticker_pack_id=sticker_set.set.id,
+                run_ocr=job.payload['ocr'],
+                run_vector=job.payload['vector'],
+                job_id=job.id,
+            )
+            for document in documents
+        ]
+
+    async def _resolve(self, jobs: list[IngestJob]) -> list[tuple[IngestJob, list[IngestItem]]]:
+        result = []
+        by_channel = defaultdict(list)
+        for job in jobs:
+            if job.kind == 'message':
+                by_channel[job.payload['channel_id']].append(job)
+            elif job.kind == 'sticker_set':
+                try:
+                    result.append((job, await self._sticker_set_items(job)))
+                except Exception as exc:
+                    logger.exception('Failed to resolve job %s', job.id)
+                    await self._fail(job.id, exc)
+            else:
+                await self._fail(job.id, ValueError(f'Unknown job kind: {job.kind}'))
+        for channel_id, channel_jobs in by_channel.items():
+            try:
+                result.extend(await self._message_items(channel_id, channel_jobs))
+            except Exception as exc:
+                logger.exception('Failed to fetch messages of channel %s', channel_id)
+                for job in channel_jobs:
+                    await self._fail(job.id, exc)
+        return result
+
+    async def _renew_leases(self):
+        while True:
+            await asyncio.sleep(LEASE.total_seconds() / 3)
+            try:
+                async with new_session():
+                    await extend_leases(list(self._in_flight))
+            except Exception:
+                logger.exception('Failed to renew job leases')
+
+    async def _poll(self) -> bool:
+        capacity = self.max_in_flight - len(self._in_flight)
+        if capacity <= 0:
+            return False
+        async with new_session():
+            jobs = await claim_jobs(capacity)
+        if not jobs:
+            return False
+        # leases are renewed for everything in _in_flight, resolving and feeding a
+        # batch can take longer than LEASE while put() waits for a full pipeline
+        for job in jobs:
+            self._in_flight[job.id] = 0
+        resolved = await self._resolve(jobs)
+        for job, items in resolved:
+            self._in_flight[job.id] = len(items)
+        empty = [job.id for job, items in resolved if not items]
+        if empty:
+            await self._finish(empty)
+        for job, items in resolved:
+            for item in items:
+                if job.id not in self._in_flight:
+                    break  # failed in the meantime
+                await self.pipeline.put(item)
+        return True
+
+    async def run(self):
+        await asyncio.to_thread(cleanup_temp_images)
+        renew_task = asyncio.create_task(self._renew_leases())
+        metrics_task = asyncio.create_task(metrics.export_loop('worker'))
+        try:
+            async with self.pipeline:
+                while True:
+                    try:
+                        claimed = await self._poll()
+                    except Exception:
+                        logger.exception('Failed to claim ingestion jobs')
+                        claimed = False
+                    if not claimed:
+                        await asyncio.sleep(POLL_INTERVAL)
+        finally:
+            renew_task.cancel()
+            metrics_task.cancel()
+
+
+async def main():
+    from app.userbot_client import create_client, lock_session, start_pool
+
+    parser = argparse.ArgumentParser(description='Run ingestion workers')
+    parser.add_argument(
+        '--session', required=True,
+        help='Telegram session used to download media, each worker process needs its own account',
+    )
+    parser.add_argument(
+        '--sessions', action='append', default=[], metavar='GLOB',
+        help='Extra accounts of this worker, e.g. "data/sessions/worker1/*.session". '
+             'Sessions directly in the sessions directory belong to the bot process',
+    )
+    parser.add_argument(
+        '--max-in-flight', type=int, default=MAX_IN_FLIGHT, help='Maximum number of jobs processed at once'
+    )
+    args = parser.parse_args()
+
+    session_file = Path(args.session)
+    # telethon adds the extension itself
+    if session_file.suffix != '.session':
+        session_file = session_file.with_name(f'{session_file.name}.session')
+    session_file = session_file.resolve()
+    if session_file in (USERBOT_SESSION_FILE.resolve(), SESSION_FILE.resolve()):
+        parser.error(f'{args.session} is used by the bot process, log in another account with app.scripts.add_account')
+    extra_sessions = sorted({Path(path).resolve() for pattern in args.sessions for path in glob.glob(pattern)})
+    if any(path.parent == SESSIONS_DIR.resolve() for path in extra_sessions):
+        parser.error(f'Sessions directly in {SESSIONS_DIR} are used by the bot process, move them to a subdirectory')
+    lock_session(session_file)
+    client = create_client(str(session_file))
+    await client.start()
+    pool = await start_pool(client, [path for path in extra_sessions if path != session_file])
+    await phash_index.refresh()
+    await IngestWorker(pool, args.max_in_flight).run()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# app.config reads these from the environment or .env, tests must not need either
+os.environ.setdefault('DB_URL', 'postgresql+asyncpg://memesearch@localhost/memesearch_test')
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='memesearch-test-'))
+os.environ.setdefault('API_ID', '1')
+os.environ.setdefault('API_HASH', 'test')
+os.environ.setdefault('BOT_TOKEN', 'test')
+os.environ.setdefault('ADMIN_GROUP_ID', '1')
+os.environ.setdefault('EXTERNAL_URL', 'http://localhost:8000')
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telethon.errors import FloodWaitError
+from telethon.tl.types import PeerChannel
+
+from app.accounts import AccountPool
+
+
+def flood_wait(seconds: int) -> FloodWaitError:
+    return FloodWaitError(request=None, capture=seconds)
+
+
+class FakeClient:
+    """Serves messages with ids history[0] > history[1] > ..., raises a flood wait after flood_after of them"""
+
+    def __init__(self, history: list[int], flood_after: int | None = None, cached: tuple = ()):
+        self.history = history
+        self.flood_after = flood_after
+        self.cached = cached
+        self.calls = []
+
+    async def get_input_entity(self, peer):
+        if not isinstance(peer, str) and peer not in self.cached:
+            raise ValueError(f'Could not find the input entity for {peer}')
+        return peer
+
+    async def iter_messages(self, entity, offset_id=0, **kwargs):
+        self.calls.append(offset_id)
+        served = 0
+        for message_id in self.history:
+            if offset_id and message_id >= offset_id:
+                continue
+            if self.flood_after is not None and served >= self.flood_after:
+                raise flood_wait(60)
+            served += 1
+            yield SimpleNamespace(id=message_id)
+
+
+async def collect(pool: AccountPool, peer, **kwargs) -> list[int]:
+    return [message.id async for message in pool.iter_messages(peer, **kwargs)]
+
+
+def test_call_routes_around_cooldown():
+    pool = AccountPool()
+    pool.add('first', FakeClient([]))
+    pool.add('second', FakeClient([]))
+    first, second = pool.accounts
+    used = []
+
+    async def func(client):
+        used.append(client)
+        if client is first.client and len(used) == 1:
+            raise flood_wait(60)
+        return client
+
+    assert asyncio.run(pool.call(func)) is second.client
+    assert used == [first.client, second.client]
+    assert not first.available
+    assert first.flood_waits == 1
+    # the cooling down account is skipped until its wait is over
+    assert asyncio.run(pool.call(func)) is second.client
+    assert first.active == second.active == 0
+
+
+def test_call_pinned_waits_out_cooldown():
+    pool = AccountPool()
+    pool.add('first', FakeClient([]))
+    pool.add('second', FakeClient([]))
+    first = pool.accounts[0]
+    first.cooldown_until = time.monotonic() + 0.05
+
+    async def func(client):
+        return client
+
+    started = time.monotonic()
+    assert asyncio.run(pool.call(func, first)) is first.client
+    assert time.monotonic() - started >= 0.05
+
+
+def test_iter_messages_resumes_below_offset_on_other_account():
+    history = list(range(10, 0, -1))
+    pool = AccountPool()
+    pool.add('first', FakeClient(history, flood_after=4))
+    pool.add('second', FakeClient(history))
+    first, second = pool.accounts
+
+    assert asyncio.run(collect(pool, 'channel')) == history
+    assert first.client.calls == [0]
+    # continues right below the last message yielded by the first account
+    assert second.client.calls == [7]
+    assert not first.available
+
+
+def test_iter_messages_keeps_explicit_offset():
+    history = list(range(10, 0, -1))
+    pool = AccountPool()
+    pool.add('first', FakeClient(history, flood_after=2))
+    pool.add('second', FakeClient(history))
+
+    assert asyncio.run(collect(pool, 'channel', offset_id=8)) == [7, 6, 5, 4, 3, 2, 1]
+    assert pool.accounts[1].client.calls == [6]
+
+
+def test_account_for_pins_peer_to_account_that_has_it_cached():
+    pool = AccountPool()
+    pool.add('first', FakeClient([]))
+    pool.add('second', FakeClient([], cached=(PeerChannel(1),)))
+
+    assert asyncio.run(pool.account_for('username')) is None
+    assert asyncio.run(pool.account_for(PeerChannel(1))) is pool.accounts[1]
+    with pytest.raises(ValueError):
+        asyncio.run(pool.account_for(PeerChannel(2)))
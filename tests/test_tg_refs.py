@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+
+from telethon.errors import rpc_message_to_error
+from telethon.tl.types import RpcError
+
+from app.tg_refs import is_file_reference_error, stale_ref_images
+
+
+def rpc_error(message: str):
+    """The exception telethon raises for an RpcError telegram sent back"""
+    return rpc_message_to_error(RpcError(400, message), None)
+
+
+def images(*tg_refs):
+    return [SimpleNamespace(id=i, tg_ref=tg_ref) for i, tg_ref in enumerate(tg_refs)]
+
+
+def test_plain_file_reference_errors_mark_every_cached_ref_stale():
+    page = images(b'ref', None, b'ref')
+    for message in ['FILE_REFERENCE_EXPIRED', 'FILE_REFERENCE_INVALID']:
+        exc = rpc_error(message)
+        assert is_file_reference_error(exc)
+        assert stale_ref_images(exc, page) == [page[0], page[2]]
+
+
+def test_indexed_file_reference_error_marks_that_ref_stale():
+    page = images(b'ref', b'ref', b'ref')
+    exc = rpc_error('FILE_REFERENCE_1_EXPIRED')
+    assert is_file_reference_error(exc)
+    assert stale_ref_images(exc, page) == [page[1]]
+
+
+def test_other_errors_are_not_stale_refs():
+    exc = rpc_error('MEDIA_EMPTY')
+    assert not is_file_reference_error(exc)
+    assert stale_ref_images(exc, images(b'ref')) == []